@@ -0,0 +1,119 @@
+"""
+In-memory autocomplete index over the crc strings of cities.
+
+There is one index per language, built on first use from the city rows
+of the LocalizedPlace read model. Entries are kept in one list sorted by
+their search key, the accent and case insensitive form of the crc made
+by the importer, so prefix matches are found with a binary search. For matches
+inside the string, the positions of all entries are indexed by the
+character n-grams they contain, and only the entries of the rarest
+n-gram of the query are checked.
+
+An index is built again on first use after the dataset version changed,
+so every process picks up the result of an import.
+"""
+
+import bisect
+import re
+import threading
+from array import array
+
+from dtrcity.cache import dataset_version
+from dtrcity.models import LocalizedPlace, make_search_key
+
+# Lengths of the n-grams that are indexed for infix matches.
+NGRAM_SIZES = (2, 3)
+# Characters that make_search_key() turns into a space.
+SEPARATOR = re.compile(r'[\W_]')
+
+# language -> (dataset version, AutocompleteIndex)
+_indexes = {}
+_lock = threading.Lock()
+
+
+def ngrams(s, n):
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class AutocompleteIndex(object):
+    """Sorted index over (geoname_id, crc, search key) rows.
+
+    Entries hold the geoname_id, not the LocalizedPlace pk, because the
+    pks change whenever the importer rewrites the read model.
+    """
+
+    def __init__(self, rows):
+        entries = sorted((key, crc, geoname_id)
+                         for geoname_id, crc, key in rows)
+        self.keys = [e[0] for e in entries]
+        self.crcs = [e[1] for e in entries]
+        self.geoname_ids = array('I', (e[2] for e in entries))
+        self.grams = {}
+        for pos, key in enumerate(self.keys):
+            for n in NGRAM_SIZES:
+                for gram in ngrams(key, n):
+                    self.grams.setdefault(gram, array('I')).append(pos)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def normalize(self, q):
+        # Keep one trailing separator, so "new " does not match "newark".
+        key = make_search_key(q)
+        if key and SEPARATOR.match(q[-1]):
+            key += ' '
+        return key
+
+    def search(self, q, size):
+        """Return the positions of up to "size" entries that contain q.
+        Entries that begin with q come first, followed by those that
+        contain q somewhere else, both in alphabetical order."""
+        q = self.normalize(q)
+        keys = self.keys
+        result = []
+        if not q or size < 1:
+            return result
+        # Prefix matches are one contiguous run of the sorted keys.
+        pos = bisect.bisect_left(keys, q)
+        while pos < len(keys) and len(result) < size and \
+                keys[pos].startswith(q):
+            result.append(pos)
+            pos += 1
+        if len(result) >= size:
+            return result
+        # Infix matches, candidates come from the rarest n-gram of q.
+        n = min(len(q), NGRAM_SIZES[-1])
+        if n < NGRAM_SIZES[0]:
+            candidates = range(len(keys))
+        else:
+            candidates = min((self.grams.get(gram, ()) for gram in
+                              ngrams(q, n)), key=len)
+        for pos in candidates:
+            if keys[pos].find(q) > 0:
+                result.append(pos)
+                if len(result) >= size:
+                    break
+        return result
+
+
+def get_index(language):
+    """Return the autocomplete index for a language, build it if there
+    is none yet for the current dataset version."""
+    version = dataset_version.get()[0]
+    entry = _indexes.get(language)
+    if entry is None or entry[0] != version:
+        with _lock:
+            entry = _indexes.get(language)
+            if entry is None or entry[0] != version:
+                rows = LocalizedPlace.objects.filter(
+                    type=3, language=language).exclude(crc='').order_by()\
+                    .values_list('geoname_id', 'crc', 'search')
+                entry = _indexes[language] = (
+                    version, AutocompleteIndex(rows.iterator()))
+    return entry[1]
+
+
+def reset_indexes():
+    """Drop all indexes, they are rebuilt on next use."""
+    with _lock:
+        _indexes.clear()
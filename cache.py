@@ -0,0 +1,193 @@
+"""
+Caches for main AltNames, the dataset version, and API responses.
+
+Main AltName objects of countries, regions and cities are keyed by
+(type, geoname_id, language) and kept in a bounded in-process LRU. If
+DTRCITY_ALTNAME_CACHE_BACKEND names a cache from settings.CACHES,
+entries are also shared through that cache, so that a process only
+queries the database for names no other process has looked up yet. A
+key that has no main AltName is cached as None.
+
+The dataset version is read from the Dataset table through the
+response cache, where it is kept for DTRCITY_VERSION_TTL seconds, and a
+process uses its copy for as long again. So every process sees a new
+version at most two TTLs after an import, also with the default
+per-process LocMem cache. Immediate invalidation across processes, when
+the importer clears the version, needs a shared cache backend, like
+memcached or redis, as DTRCITY_RESPONSE_CACHE.
+Serialized API responses are kept in the response cache under keys
+that contain the dataset version, so an import makes them all stale.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Max. number of entries in the in-process LRU.
+CACHE_SIZE = getattr(settings, 'DTRCITY_ALTNAME_CACHE_SIZE', 10000)
+# Seconds an entry is kept, in process and in the shared cache.
+CACHE_TIMEOUT = getattr(settings, 'DTRCITY_ALTNAME_CACHE_TIMEOUT', 300)
+# Alias of the shared cache in settings.CACHES, or None.
+CACHE_BACKEND = getattr(settings, 'DTRCITY_ALTNAME_CACHE_BACKEND', None)
+# Alias of the cache in settings.CACHES for API responses.
+RESPONSE_CACHE = getattr(settings, 'DTRCITY_RESPONSE_CACHE', 'default')
+# Seconds a serialized API response is kept.
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'DTRCITY_RESPONSE_CACHE_TIMEOUT',
+                                 24 * 60 * 60)
+# Seconds a process uses the dataset version before reading it again.
+VERSION_TTL = getattr(settings, 'DTRCITY_VERSION_TTL', 10)
+
+
+class MainAltNameCache(object):
+    """Two level cache: bounded LRU in process, optional shared cache.
+
+    clear() and delete() bump a generation number in the shared cache,
+    which is part of every shared key and stored with every local entry,
+    so that all entries written before are ignored by every process.
+    Local entries also keep the dataset version, so without a shared
+    cache the other processes drop them when they see a new version.
+    """
+
+    gen_key = 'dtrcity:altname:gen'
+
+    def __init__(self, size=CACHE_SIZE, timeout=CACHE_TIMEOUT,
+                 backend=CACHE_BACKEND):
+        self.size = size
+        self.timeout = timeout
+        self.backend = backend
+        self.lock = threading.Lock()
+        # key -> (expiry timestamp, generation, AltName or None), least
+        # recent first.
+        self.entries = OrderedDict()
+
+    def get_backend(self):
+        return caches[self.backend] if self.backend else None
+
+    def backend_key(self, gen, key):
+        return 'dtrcity:altname:{0}:{1}:{2}:{3}'.format(gen, *key)
+
+    def generation(self, backend):
+        """Return the dataset version and the shared generation number."""
+        gen = backend.get(self.gen_key, 0) if backend is not None else 0
+        return dataset_version.get()[0], gen
+
+    def get_many(self, keys):
+        """Return a dict with the cached value of every key found."""
+        found = {}
+        now = time.time()
+        backend = self.get_backend()
+        generation = self.generation(backend)
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now and \
+                        entry[1] == generation:
+                    self.entries.move_to_end(key)
+                    found[key] = entry[2]
+        missing = [key for key in keys if key not in found]
+        if backend is not None and missing:
+            bkeys = {self.backend_key(generation[1], key): key
+                     for key in missing}
+            shared = {bkeys[k]: v for k, v in backend.get_many(bkeys).items()}
+            self.set_local(generation, shared)
+            found.update(shared)
+        return found
+
+    def set_many(self, values):
+        """Cache the values of a dict, in process and in the shared cache."""
+        backend = self.get_backend()
+        generation = self.generation(backend)
+        self.set_local(generation, values)
+        if backend is not None and values:
+            backend.set_many({self.backend_key(generation[1], k): v
+                              for k, v in values.items()}, self.timeout)
+
+    def set_local(self, generation, values):
+        expires = time.time() + self.timeout
+        with self.lock:
+            for key, value in values.items():
+                self.entries[key] = (expires, generation, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        # Other processes may have a copy of the entry, so all entries
+        # are dropped. Names only change this way when edited by hand.
+        with self.lock:
+            self.entries.pop(key, None)
+        self.bump()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.bump()
+
+    def bump(self):
+        backend = self.get_backend()
+        if backend is not None:
+            try:
+                backend.incr(self.gen_key)
+            except ValueError:  # Not set yet, or expired.
+                backend.set(self.gen_key, 1, None)
+
+
+class DatasetVersion(object):
+    """Process-local copy of the (version, updated) values of the
+    Dataset row, read through the response cache."""
+
+    key = 'dtrcity:dataset'
+
+    def __init__(self, ttl=VERSION_TTL, backend=RESPONSE_CACHE):
+        self.ttl = ttl
+        self.backend = backend
+        self.value = None
+        self.expires = 0
+
+    def get(self):
+        """Return (version, updated), updated is a datetime or None."""
+        if self.value is None or self.expires <= time.time():
+            backend = caches[self.backend]
+            value = backend.get(self.key)
+            if value is None:
+                from dtrcity.models import Dataset
+                obj = Dataset.current()
+                value = (obj.version, obj.updated)
+                backend.set(self.key, value, self.ttl)
+            self.value, self.expires = value, time.time() + self.ttl
+        return self.value
+
+    def clear(self):
+        self.value = None
+        caches[self.backend].delete(self.key)
+
+
+class ResponseCache(object):
+    """Serialized API responses, keyed by view, dataset version, language,
+    and query parameters."""
+
+    def __init__(self, timeout=RESPONSE_CACHE_TIMEOUT,
+                 backend=RESPONSE_CACHE):
+        self.timeout = timeout
+        self.backend = backend
+
+    def key(self, name, version, language, params):
+        # Hashed, the query parameters may be long or contain any chars.
+        params = hashlib.md5(repr(sorted(params)).encode('utf-8'))
+        return 'dtrcity:response:{0}:{1}:{2}:{3}'.format(
+            name, version, language, params.hexdigest())
+
+    def get(self, key):
+        return caches[self.backend].get(key)
+
+    def set(self, key, content):
+        caches[self.backend].set(key, content, self.timeout)
+
+
+main_altnames = MainAltNameCache()
+dataset_version = DatasetVersion()
+responses = ResponseCache()
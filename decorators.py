@@ -0,0 +1,114 @@
+import calendar
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.translation import get_language
+
+from dtrcity.cache import dataset_version, responses
+
+# Seconds clients and proxies may use a response without asking again.
+CACHE_MAX_AGE = getattr(settings, 'DTRCITY_CACHE_MAX_AGE', 300)
+
+
+def etag_matches(request, etag):
+    """Return True if the request's If-None-Match header contains etag.
+
+    This is the weak comparison that If-None-Match uses, so a "W/" added
+    by a proxy that compressed the response still matches.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH', '').strip()
+    tags = parse_etags(header)  # Without "W/" and quotes.
+    return etag.strip('"') in tags or '*' in tags
+
+
+def not_modified(request, etag, last_modified):
+    """Return True if the client's copy, described by If-None-Match or
+    else If-Modified-Since, is still current."""
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        return etag_matches(request, etag)
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return since is not None and last_modified is not None and \
+        last_modified <= since
+
+
+def cache_stream(key, chunks):
+    """Yield the chunks of a streamed response, and cache their bytes
+    once the stream is complete."""
+    content = []
+    for chunk in chunks:
+        content.append(chunk)
+        yield chunk
+    responses.set(key, b''.join(content))
+
+
+def versioned(view, params, cache):
+    """Wrap a JSON view for conditional GET, see conditional_response()."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        version, updated = dataset_version.get()
+        language = get_language()[:2]
+        values = [(k, request.GET.get(k)) for k in params]
+        values += sorted(kwargs.items())
+        key = responses.key(view.__name__, version, language, values)
+        etag = '"{0}-{1}"'.format(
+            language, hashlib.md5(key.encode('utf-8')).hexdigest())
+        last_modified = None
+        if updated is not None:
+            # Naive if USE_TZ is False, then it is in the local time zone.
+            if timezone.is_naive(updated):
+                updated = timezone.make_aware(updated)
+            last_modified = calendar.timegm(updated.utctimetuple())
+
+        if not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            content = responses.get(key) if cache else None
+            if content is not None:
+                response = HttpResponse(content,
+                                        content_type='application/json')
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if cache and response.streaming:
+                    response.streaming_content = cache_stream(
+                        key, response.streaming_content)
+                elif cache:
+                    responses.set(key, response.content)
+
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True, max_age=CACHE_MAX_AGE)
+        # The language comes from the Accept-Language header or the
+        # language cookie, shared caches must keep one copy per value.
+        patch_vary_headers(response, ('Accept-Language', 'Cookie'))
+        return response
+    return wrapper
+
+
+def conditional_response(*params):
+    """Add ETag, Last-Modified and Cache-Control headers to a JSON view.
+
+    The strong ETag is made from the view name, the dataset version, the
+    language, the URL arguments and the values of the GET parameters in
+    "params", which are all the view's response depends on. Responses
+    vary by Accept-Language and Cookie, which select the language.
+    Last-Modified is the time of the last import. A request with a
+    matching If-None-Match, or without it and with a current
+    If-Modified-Since, gets a "304 Not Modified" before the view touches
+    the database.
+    """
+    return lambda view: versioned(view, params, cache=False)
+
+
+def cached_response(*params):
+    """Like conditional_response(), and also keep the serialized bytes of
+    the view's responses with status 200 in the response cache, under a
+    key made from the same values as the ETag."""
+    return lambda view: versioned(view, params, cache=True)
@@ -0,0 +1,137 @@
+"""
+Opt-in query count and latency instrumentation for the API views.
+
+Add "dtrcity.instrumentation.InstrumentationMiddleware" to the
+middleware classes to use it. For every request to a dtrcity view it
+records the number of queries, the time spent in the database, in JSON
+encoding and in total, and the response size. The values of a request
+are sent in a "Server-Timing" header, and the values of all requests
+are aggregated per view in this process. With the DTRCITY_STATS_VIEW
+setting True, the "stats.txt" view returns them in the Prometheus text
+format.
+"""
+
+import bisect
+import threading
+import time
+
+from django.db import connection
+
+# Upper bounds [ms] of the latency histogram buckets.
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_local = threading.local()
+
+
+def add_serialization_time(secs):
+    """Add JSON encoding time to the current request, if it is measured."""
+    if getattr(_local, 'serialize', None) is not None:
+        _local.serialize += secs
+
+
+class ViewStats(object):
+    """Aggregated values of all requests to one view."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_ms = 0.0
+        self.serialize_ms = 0.0
+        self.total_ms = 0.0
+        self.bytes = 0
+        # Counts per bucket, the last one is for all slower requests.
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, queries, db_ms, serialize_ms, total_ms, size):
+        self.requests += 1
+        self.queries += queries
+        self.db_ms += db_ms
+        self.serialize_ms += serialize_ms
+        self.total_ms += total_ms
+        self.bytes += size
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, total_ms)] += 1
+
+
+class Stats(object):
+    """ViewStats of all views of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, view, *values):
+        with self.lock:
+            self.views.setdefault(view, ViewStats()).add(*values)
+
+    def prometheus(self):
+        """Return all values in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            items = sorted(self.views.items())
+            for name, metric, help in (
+                    ('requests', 'dtrcity_requests_total', 'Requests.'),
+                    ('queries', 'dtrcity_queries_total', 'DB queries.'),
+                    ('db_ms', 'dtrcity_db_ms_total', 'DB time [ms].'),
+                    ('serialize_ms', 'dtrcity_serialize_ms_total',
+                     'JSON encoding time [ms].'),
+                    ('bytes', 'dtrcity_response_bytes_total',
+                     'Response bytes.')):
+                lines.append('# HELP {0} {1}'.format(metric, help))
+                lines.append('# TYPE {0} counter'.format(metric))
+                for view, stats in items:
+                    lines.append('{0}{{view="{1}"}} {2}'.format(
+                                 metric, view, getattr(stats, name)))
+            metric = 'dtrcity_latency_ms'
+            lines.append('# HELP {0} Total request time [ms].'.format(metric))
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for view, stats in items:
+                cnt = 0
+                for le, n in zip(LATENCY_BUCKETS + ('+Inf', ), stats.buckets):
+                    cnt += n
+                    lines.append('{0}_bucket{{view="{1}",le="{2}"}} {3}'
+                                 .format(metric, view, le, cnt))
+                lines.append('{0}_sum{{view="{1}"}} {2}'.format(
+                             metric, view, stats.total_ms))
+                lines.append('{0}_count{{view="{1}"}} {2}'.format(
+                             metric, view, stats.requests))
+        return '\n'.join(lines) + '\n'
+
+
+stats = Stats()
+
+
+class InstrumentationMiddleware(object):
+    """Measure requests to dtrcity views, see the module docstring."""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not view_func.__module__.startswith('dtrcity.'):
+            return None
+        request.dtrcity_view = view_func.__name__
+        request.dtrcity_started = time.time()
+        request.dtrcity_queries = len(connection.queries_log)
+        request.dtrcity_debug_cursor = connection.force_debug_cursor
+        # Record the queries, with their time, also when DEBUG is off.
+        connection.force_debug_cursor = True
+        _local.serialize = 0.0
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'dtrcity_view'):
+            return response
+        total_ms = (time.time() - request.dtrcity_started) * 1000
+        queries = list(connection.queries_log)[request.dtrcity_queries:]
+        connection.force_debug_cursor = request.dtrcity_debug_cursor
+        db_ms = sum(float(q['time']) for q in queries) * 1000
+        serialize_ms = (_local.serialize or 0.0) * 1000
+        _local.serialize = None
+        # Streamed responses are encoded after this point, their size is
+        # not known here.
+        size = 0 if response.streaming else len(response.content)
+
+        stats.add(request.dtrcity_view, len(queries), db_ms, serialize_ms,
+                  total_ms, size)
+        response['Server-Timing'] = ', '.join([
+            'db;dur={0:.2f};desc="{1} queries"'.format(db_ms, len(queries)),
+            'serialize;dur={0:.2f}'.format(serialize_ms),
+            'total;dur={0:.2f}'.format(total_ms)])
+        return response
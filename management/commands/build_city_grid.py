@@ -0,0 +1,58 @@
+"""
+Build the precomputed nearest city grid for fast reverse geocoding.
+
+The grid file is written to the path in settings.DTRCITY_CITY_GRID, or
+the --output path. Run it after "import_cities" whenever cities change.
+City.by_latlng uses the grid as soon as DTRCITY_CITY_GRID is set, but
+only if the file is newer than the last import, and the spatial index
+otherwise.
+"""
+
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dtrcity.models import City, NEAREST_CITY_MAX_DISTANCE
+from dtrcity.spatial import CityGrid
+
+
+class Command(BaseCommand):
+    help = 'Build the nearest city grid file used by City.by_latlng.'
+    option_list = BaseCommand.option_list + (
+        make_option('--resolution', type='float', default=getattr(
+                        settings, 'DTRCITY_CITY_GRID_RESOLUTION', 0.1),
+                    help='Cell size in degrees, e.g. 0.05.'),
+        make_option('--output', default=getattr(
+                        settings, 'DTRCITY_CITY_GRID', None),
+                    help='Path of the grid file to write.'), )
+
+    def handle(self, *args, **options):
+        filename = options['output']
+        resolution = options['resolution']
+        if not filename:
+            raise CommandError('Set DTRCITY_CITY_GRID or use --output.')
+        if not 0 < resolution <= 10:
+            raise CommandError('Resolution must be in (0, 10] degrees.')
+
+        points = list(City.objects.order_by('pk')
+                      .values_list('pk', 'lat', 'lng'))
+        rows = int(round(180.0 / resolution))
+        print('Building {0} x {1} grid for {2} cities...'.format(
+              rows, int(round(360.0 / resolution)), len(points)))
+        started = time.time()
+
+        def progress(row):
+            if row % 100 == 0 or row == rows:
+                print('{0}/{1} rows done in {2:.0f} s.'.format(
+                      row, rows, time.time() - started))
+
+        # Write to a temporary file first and then replace the old grid,
+        # so that processes that map the old file are not affected.
+        tmp = filename + '.tmp'
+        CityGrid.write(tmp, points, resolution, NEAREST_CITY_MAX_DISTANCE,
+                       progress)
+        os.replace(tmp, filename)
+        print('Grid written to {0}.'.format(filename))
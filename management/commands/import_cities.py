@@ -5,6 +5,17 @@ This is "cities_very_light" but language aware. AltNames are imported in
 various different languages (defined in settings.LANGUAGES list),
 and different ways of spelling for the same location. Each location has
 a main way to spell it "is_main" that should be used for display.
+
+A full import updates the AltNames of an earlier run in place, matched
+by their geonames alternateNameId. Names without an alternateNameId, as
+in a database dump of a version before the id was stored, are removed
+by the import_alt_name stage and replaced, so run a full import once
+before the first --incremental run on such a database.
+
+With --incremental, only the daily modification and deletion files of
+geonames are applied to existing rows, and the main names, crc and url
+strings, and read model rows of the changed geo objects are recomputed.
+The files are read from --diff-dir, so a run can use local files.
 """
 
 import time
@@ -13,13 +24,33 @@ from optparse import make_option
 from urllib.request import urlopen
 
 import codecs
+import collections
+import cProfile
 import io
+import itertools
+import json
+import multiprocessing
 import os
+import queue
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Case, Value, When
 from django.utils.text import slugify
 
-from dtrcity.models import Country, Region, City, AltName
+from dtrcity import autocomplete, readmodel
+from dtrcity.cache import main_altnames
+from dtrcity.models import Country, Region, City, AltName, Dataset, \
+    make_search_key
+from dtrcity.spatial import cell_id
 
 
 conf = dict()
@@ -58,7 +89,24 @@ conf['FILES'] = {
     'postal_code':  {
         'filename': 'allCountries.zip',
         'urls':     [conf['URL_BASES']['geonames']['zip']+'{filename}', ]
-    }
+    },
+    # The daily diffs, their filenames contain the date as YYYY-MM-DD.
+    'modifications': {
+        'filename': 'modifications-{date}.txt',
+        'urls':     [conf['URL_BASES']['geonames']['dump']+'{filename}', ]
+    },
+    'deletes':      {
+        'filename': 'deletes-{date}.txt',
+        'urls':     [conf['URL_BASES']['geonames']['dump']+'{filename}', ]
+    },
+    'alt_name_modifications': {
+        'filename': 'alternateNamesModifications-{date}.txt',
+        'urls':     [conf['URL_BASES']['geonames']['dump']+'{filename}', ]
+    },
+    'alt_name_deletes': {
+        'filename': 'alternateNamesDeletes-{date}.txt',
+        'urls':     [conf['URL_BASES']['geonames']['dump']+'{filename}', ]
+    },
 }
 conf['COUNTRY_CODES'] = [
     'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AQ', 'AR', 'AS', 'AT',
@@ -86,6 +134,352 @@ conf['COUNTRY_CODES'] = [
 # See http://www.geonames.org/export/codes.html
 conf['CITY_TYPES'] = ['PPL', 'PPLA', 'PPLC', 'PPLA2', 'PPLA3', 'PPLA4']
 conf['DISTRICT_TYPES'] = ['PPLX']
+# Min. population of a city, as in cities15000. Capitals are always added.
+conf['CITY_MIN_POPULATION'] = 15000
+# Number of rows written per transaction.
+conf['BATCH_SIZE'] = getattr(settings, 'DTRCITY_IMPORT_BATCH_SIZE', 1000)
+# Number of processes that parse alternateNames, 1 parses in process.
+# More workers need the "fork" start method, which is not available on
+# Windows, because spawned workers would import this module without
+# django.setup().
+conf['WORKERS'] = getattr(settings, 'DTRCITY_IMPORT_WORKERS', 1)
+# Number of lines a worker parses at a time.
+conf['PARSE_BLOCK_SIZE'] = getattr(settings, 'DTRCITY_IMPORT_PARSE_BLOCK_SIZE',
+                                   5000)
+# Seconds between two progress lines of a stage.
+conf['PROGRESS_INTERVAL'] = getattr(settings,
+                                    'DTRCITY_IMPORT_PROGRESS_INTERVAL', 10)
+# The import stages, in the order they run.
+conf['STAGES'] = [
+    'import_country',
+    'import_region',
+    'import_city',
+    'import_alt_name',  # all altnames from geonames db
+    'fillup_alt_name',  # add all orig names from country, region, city
+    'define_main_alt_names',  # set exactly one name per lg to 'main'
+    'make_crc_for_main_alt_names',  # create crc and url strings
+    'build_read_model',  # swap in a fresh LocalizedPlace table
+]
+# The stages of an --incremental import, which apply the daily diffs and
+# then recompute only the geo objects that were changed.
+conf['INCREMENTAL_STAGES'] = [
+    'apply_deletes',
+    'apply_modifications',
+    'apply_alt_name_deletes',
+    'apply_alt_name_modifications',
+    'fillup_alt_name',
+    'define_main_alt_names',
+    'make_crc_for_main_alt_names',
+    'refresh_read_model',  # replace the changed LocalizedPlace rows
+]
+
+
+def bulk_update(model, objs, fields):
+    """Write the given fields of all objs with few UPDATE queries.
+
+    Each field is set with a "CASE pk WHEN ... THEN ..." expression,
+    because QuerySet.bulk_update() does not exist in this Django version.
+    Every object takes two query parameters per field and one for the
+    pk filter, so the objects are split to stay within the database's
+    limit of query parameters, like bulk_create() does.
+    """
+    if not objs or not fields:
+        return
+    fields = [model._meta.get_field(name) for name in fields]
+    params = [model._meta.pk] * (2 * len(fields) + 1)
+    size = max(connection.ops.bulk_batch_size(params, objs), 1)
+    for i in range(0, len(objs), size):
+        batch = objs[i:i + size]
+        values = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                                output_field=field))
+                     for obj in batch]
+            values[field.attname] = Case(*whens, output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            **values)
+
+
+def chunked(ids, size):
+    """Yield the sorted ids in lists of at most size ids."""
+    ids = sorted(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def read_lines(filename):
+    """Yield the lines of a UTF-8 text file."""
+    with open(filename, 'r', encoding='utf-8') as fh:
+        for line in fh:
+            yield line
+
+
+def read_zip_lines(filename, member):
+    """Yield the lines of a UTF-8 text file inside a zip file, decoded
+    and split while the member is decompressed."""
+    with zipfile.ZipFile(filename, mode='r') as zf:
+        with zf.open(member, 'r') as fh:
+            for line in io.TextIOWrapper(fh, encoding='utf-8'):
+                yield line
+
+
+def read_ahead(lines, block_size=1000, max_blocks=16):
+    """Yield from the lines iterator, reading it in a background thread.
+
+    This lets decompression and decoding in the reader overlap with the
+    parsing and writing of the consumer. At most max_blocks blocks of
+    block_size lines are buffered.
+    """
+    blocks = queue.Queue(maxsize=max_blocks)
+    done = object()
+
+    def reader():
+        try:
+            block = []
+            for line in lines:
+                block.append(line)
+                if len(block) >= block_size:
+                    blocks.put(block)
+                    block = []
+            blocks.put(block)
+            blocks.put(done)
+        except Exception as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    while True:
+        block = blocks.get()
+        if block is done:
+            break
+        if isinstance(block, Exception):
+            raise block
+        for line in block:
+            yield line
+
+
+def parse_lines(lines):
+    """Yield the tab separated items of all lines that are not empty or
+    comments."""
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if len(line) < 1 or line[0] == '#':
+            continue
+        yield [e.strip() for e in line.split('\t')]
+
+
+# The AltName fields, in the order parse_alt_name() returns their values.
+ALT_NAME_FIELDS = ('alternatename_id', 'geoname_id', 'language', 'name',
+                   'slug', 'type', 'is_preferred', 'is_short',
+                   'is_colloquial', 'is_historic')
+
+
+def parse_alt_name(items, languages, geo_index):
+    """Return the ALT_NAME_FIELDS values of an alternate name row, or the
+    reason why the row is skipped, as a string."""
+    # Verify that the "name" items[3] contains a string:
+    item_name = items[3].strip()
+    if not item_name:
+        return 'empty name'
+
+    # Only get names for languages in use.
+    if items[2] not in languages:
+        return 'language'
+
+    # The geoname_id of the item.
+    item_geoname_id = int(items[1])
+    if not item_geoname_id:
+        return 'no geoname_id'
+
+    # Find type (1=country, 2=region, or 3=city) for the item.
+    item_type = geo_index.get(item_geoname_id)
+    if item_type is None:
+        return 'geoname type'
+
+    # The alternateNameId is kept to find the row again in the daily diffs.
+    return (int(items[0]), item_geoname_id, items[2], item_name,
+            slugify(item_name), item_type, bool(items[4]), bool(items[5]),
+            bool(items[6]), bool(items[7]))
+
+
+# The languages and geo index of a worker process, see init_alt_name_worker.
+_worker = {}
+
+
+def init_alt_name_worker(languages, geo_index):
+    _worker['languages'] = languages
+    _worker['geo_index'] = geo_index
+
+
+def transform_alt_names(lines):
+    """Parse a block of alternateNames lines, in a worker process.
+
+    Returns the list of ALT_NAME_FIELDS values of the imported rows, in
+    the order of the lines, and a Counter of the skipped rows by reason.
+    """
+    rows = []
+    skipped = collections.Counter()
+    for items in parse_lines(lines):
+        values = parse_alt_name(items, _worker['languages'],
+                                _worker['geo_index'])
+        if isinstance(values, str):
+            skipped[values] += 1
+        else:
+            rows.append(values)
+    return rows, skipped
+
+
+def map_ordered(pool, func, items, max_pending):
+    """Yield func(item) for all items, computed by the pool, in the order
+    of the items. Unlike Pool.imap(), at most max_pending items are read
+    ahead, so the memory use does not grow with the number of items."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item, )))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def peak_rss_kb():
+    """Return the peak resident memory of this process in KB, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class QueryCounter(collections.deque):
+    """Stand-in for connection.queries_log that only counts the queries
+    the debug cursor logs, instead of keeping them."""
+
+    def __init__(self):
+        super(QueryCounter, self).__init__()
+        self.count = 0
+
+    def append(self, query):
+        self.count += 1
+
+
+class Stage(object):
+    """Measures one import stage: time, rows processed, rows skipped by
+    reason, and queries. Prints a progress line at most every "interval"
+    seconds, instead of one line per row."""
+
+    def __init__(self, name, queries, interval):
+        self.name = name
+        self.queries = queries
+        self.interval = interval
+        self.rows = 0
+        self.skipped = collections.Counter()
+        self.started = time.time()
+        self.queries_started = queries.count
+        self.next_progress = self.started + interval
+
+    def row(self):
+        self.rows += 1
+        if time.time() >= self.next_progress:
+            self.progress()
+
+    def skip(self, reason):
+        self.skipped[reason] += 1
+        self.row()
+
+    def add(self, rows, skipped):
+        """Count a number of rows and a Counter of skipped rows at once."""
+        self.skipped.update(skipped)
+        self.rows += rows + sum(skipped.values())
+        if time.time() >= self.next_progress:
+            self.progress()
+
+    def progress(self):
+        secs = time.time() - self.started
+        print('{0}: {1} rows, {2} skipped, {3:.0f} rows/s after {4:.0f} s.'
+              .format(self.name, self.rows, sum(self.skipped.values()),
+                      self.rows / secs if secs else 0, secs))
+        self.next_progress = time.time() + self.interval
+
+    def summary(self):
+        secs = time.time() - self.started
+        return {
+            'stage': self.name,
+            'seconds': round(secs, 3),
+            'rows': self.rows,
+            'rows_per_second': round(self.rows / secs, 1) if secs else 0,
+            'skipped': dict(self.skipped),
+            'queries': self.queries.count - self.queries_started,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+
+
+class BatchWriter(object):
+    """Collect model objects of one import stage and write them in
+    batches, one transaction per batch.
+
+    add() queues new rows for bulk_create(), change() queues existing
+    rows for an update of "fields", and upsert() decides between the two
+    when the batch is written, by the object's "key" field, the pk by
+    default. Objects that match an existing row by another key get the
+    row's pk. Call close() at the end
+    of the stage to write the remaining rows. The rate of the stage is
+    reported by its Stage.
+    """
+
+    def __init__(self, stage, model, batch_size, fields=None, key='pk'):
+        self.stage = stage
+        self.model = model
+        self.batch_size = batch_size
+        self.fields = fields or []
+        self.key = key
+        self.rows = 0
+        self.created = []
+        self.upserted = []
+        # Keyed by pk, so that a later change of an object wins.
+        self.changed = {}
+
+    def add(self, obj):
+        self.created.append(obj)
+        self.flush_if_full()
+
+    def upsert(self, obj):
+        self.upserted.append(obj)
+        self.flush_if_full()
+
+    def change(self, obj):
+        self.changed[obj.pk] = obj
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        if len(self.created) + len(self.upserted) + \
+                len(self.changed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        created, changed = self.created, list(self.changed.values())
+        if self.upserted:
+            keys = [getattr(obj, self.key) for obj in self.upserted]
+            existing = dict(self.model.objects.filter(
+                **{self.key + '__in': keys}).values_list(self.key, 'pk'))
+            for obj in self.upserted:
+                pk = existing.get(getattr(obj, self.key))
+                if pk is None:
+                    created.append(obj)
+                else:
+                    obj.pk = pk
+                    changed.append(obj)
+        with transaction.atomic():
+            if created:
+                self.model.objects.bulk_create(created)
+            bulk_update(self.model, changed, self.fields)
+        self.rows += len(created) + len(changed)
+        self.created, self.upserted, self.changed = [], [], {}
+
+    def close(self):
+        self.flush()
+        print('{0}: {1} rows written.'.format(self.stage, self.rows))
+        return self.rows
 
 
 class Command(BaseCommand):
@@ -93,19 +487,97 @@ class Command(BaseCommand):
                        os.path.join(settings.BASE_DIR, 'import_data'))
     option_list = BaseCommand.option_list + (
         make_option('--force', action='store_true', default=False,
-                    help='Import even if files are up-to-date.'), )
+                    help='Import even if files are up-to-date.'),
+        make_option('--batch-size', type='int', default=conf['BATCH_SIZE'],
+                    help='Number of rows written per transaction.'),
+        make_option('--profile-dir', default=None,
+                    help='Write a cProfile dump of each stage into this '
+                         'directory.'),
+        make_option('--summary', default=None,
+                    help='Write the JSON summary of all stages into this '
+                         'file.'),
+        make_option('--workers', type='int', default=conf['WORKERS'],
+                    help='Number of processes that parse alternateNames, '
+                         'more than 1 needs a platform with fork().'),
+        make_option('--incremental', action='store_true', default=False,
+                    help='Apply the daily modification and deletion files '
+                         'of --date, instead of a full import.'),
+        make_option('--date', default=None,
+                    help='Date (YYYY-MM-DD) of the daily files for '
+                         '--incremental, default is yesterday (UTC).'),
+        make_option('--diff-dir', default=None,
+                    help='Directory of the daily files. Files that are '
+                         'not there are downloaded into it. Default is '
+                         'the import data directory.'), )
 
     def handle(self, *args, **options):
         self.download_cache = {}
         self.options = options
         self.force = self.options['force']
-        self.import_country()
-        self.import_region()
-        self.import_city()
-        self.import_alt_name()  # all altnames from geonames db
-        self.fillup_alt_name()  # add all orig names from country, region, city
-        self.define_main_alt_names()  # set exactly one name per lg to 'main'
-        self.make_crc_for_main_alt_names()  # create crc and url strings
+        self.batch_size = self.options['batch_size']
+        self.profile_dir = self.options['profile_dir']
+        self.workers = self.options['workers']
+        self.stages = []
+        # The geoname_ids changed by an incremental import, or None to
+        # process all of them.
+        self.affected = None
+        stages = conf['STAGES']
+        if self.options['incremental']:
+            self.affected = set()
+            stages = conf['INCREMENTAL_STAGES']
+            self.date = self.options['date'] or time.strftime(
+                '%Y-%m-%d', time.gmtime(time.time() - 24 * 60 * 60))
+            self.diff_dir = self.options['diff_dir'] or self.data_dir
+
+        # Count all queries, through the debug cursor, also if DEBUG is off.
+        self.queries = QueryCounter()
+        queries_log = connection.queries_log
+        debug_cursor = connection.force_debug_cursor
+        connection.queries_log = self.queries
+        connection.force_debug_cursor = True
+        try:
+            for name in stages:
+                self.run_stage(name)
+        finally:
+            connection.queries_log = queries_log
+            connection.force_debug_cursor = debug_cursor
+            self.report()
+
+        Dataset.bump()  # new version for cached responses and ETags
+        main_altnames.clear()  # bulk writes do not send post_save signals
+        autocomplete.reset_indexes()
+
+    def run_stage(self, name):
+        """Run one stage, measured by a Stage, and with cProfile if a
+        profile directory is set."""
+        self.stage = Stage(name, self.queries, conf['PROGRESS_INTERVAL'])
+        profile = cProfile.Profile() if self.profile_dir else None
+        if profile is not None:
+            profile.enable()
+        try:
+            getattr(self, name)()
+        finally:
+            if profile is not None:
+                profile.disable()
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                profile.dump_stats(os.path.join(self.profile_dir,
+                                                name + '.prof'))
+            self.stages.append(self.stage.summary())
+            self.stage.progress()
+
+    def report(self):
+        """Print the summary of all stages that ran, as JSON, and write it
+        to the --summary file if there is one."""
+        summary = {'stages': self.stages,
+                   'seconds': round(sum(e['seconds'] for e in self.stages), 3),
+                   'queries': self.queries.count,
+                   'peak_rss_kb': peak_rss_kb()}
+        content = json.dumps(summary, indent=2, sort_keys=True)
+        print(content)
+        if self.options['summary']:
+            with open(self.options['summary'], 'w') as fh:
+                fh.write(content)
 
     def download(self, filekey):
         filename = conf['FILES'][filekey]['filename']
@@ -168,29 +640,48 @@ class Command(BaseCommand):
         return uptodate
 
     def get_data(self, filekey):
+        """Return a generator over the lines of the data file.
+
+        Zip files are decompressed incrementally, so only a few blocks of
+        lines are held in memory, independent of the file size.
+        """
         filename = conf['FILES'][filekey]['filename']
         name, ext = filename.rsplit('.', 1)
+        fn = os.path.join(self.data_dir, filename)
         if ext == 'zip':
             print('Unzip file: ' + filename)
-            fn = os.path.join(self.data_dir, filename)
-            with open(fn, 'rb') as file:
-                zf = zipfile.ZipFile(file, mode='r')
-                with zf.open(name + '.txt', 'rU') as zip:
-                    data = io.TextIOWrapper(io.BytesIO(zip.read()))
-            # print(data)
+            return read_ahead(read_zip_lines(fn, name + '.txt'))
+        print('Regular txt file: ' + filename)
+        return read_ahead(read_lines(fn))
+
+    def get_diff(self, filekey):
+        """Return the rows of the daily file of self.date, read from the
+        diff directory. The file is downloaded if it is not there."""
+        filename = conf['FILES'][filekey]['filename'].format(date=self.date)
+        fn = os.path.join(self.diff_dir, filename)
+        if os.path.exists(fn):
+            print('Using local file: ' + fn)
         else:
-            print('Regular txt file: ' + filename)
-            fn = os.path.join(self.data_dir, filename)
-            with open(fn, 'r') as fh:
-                data = fh.read().split('\n')
-        return data
+            url = conf['FILES'][filekey]['urls'][0].format(filename=filename)
+            print('Downloading: ' + url)
+            content = urlopen(url).read()
+            if not os.path.exists(self.diff_dir):
+                os.makedirs(self.diff_dir)
+            with open(fn, 'wb') as fh:
+                fh.write(content)
+        return list(self.parse(read_lines(fn)))
+
+    def restrict(self, queryset, field='geoname_id'):
+        """Return a list of querysets, that together select the rows of
+        queryset whose field is one of the affected geoname_ids, or all
+        rows if the import is not incremental."""
+        if self.affected is None:
+            return [queryset]
+        return [queryset.filter(**{field + '__in': chunk})
+                for chunk in chunked(self.affected, self.batch_size)]
 
     def parse(self, data):
-        for line in data:
-            if len(line) < 1 or line[0] == '#':
-                continue
-            items = [e.strip() for e in line.split('\t')]
-            yield items
+        return parse_lines(data)
 
     def build_country_index(self):
         if hasattr(self, 'country_index'):
@@ -215,26 +706,23 @@ class Command(BaseCommand):
         print('{} items in region_index.'.format(len(self.region_index)))
 
     def build_geo_index(self):
+        """Map every country, region and city geoname_id to its AltName
+        type (1=country, 2=region, 3=city)."""
         if hasattr(self, 'geo_index'):
-            s = 'Geo index exists, item count is country: {}, ' \
-                'region: {}, and city: {} items.'
-            print(s.format(len(self.geo_index['country']),
-                           len(self.geo_index['region']),
-                           len(self.geo_index['city'])))
+            s = 'Geo index exists, with {} items in geo_index.'
+            print(s.format(len(self.geo_index)))
             return
         print('Building geo index...')
-        self.geo_index = {'country': [], 'region': [], 'city': []}
-        for obj in Country.objects.all():
-            self.geo_index['country'].append(obj.id)
-        for obj in Region.objects.all():
-            self.geo_index['region'].append(obj.id)
-        for obj in City.objects.all():
-            self.geo_index['city'].append(obj.id)
-        s = 'Geo index built, item count is country: {}, ' \
-            'region: {}, and city: {} items.'
-        print(s.format(len(self.geo_index['country']),
-                       len(self.geo_index['region']),
-                       len(self.geo_index['city'])))
+        self.geo_index = {}
+        # Fill in cities first, so that on a shared id a country or region
+        # wins, the same lookup order as country, region, city.
+        for type, model in ((3, City), (2, Region), (1, Country)):
+            ids = model.objects.order_by().values_list('id', flat=True)
+            self.geo_index.update(dict.fromkeys(ids.iterator(), type))
+        size = sys.getsizeof(self.geo_index) + \
+            sum(sys.getsizeof(k) for k in self.geo_index)
+        s = 'Geo index built, with {0} items using {1:.1f} MB.'
+        print(s.format(len(self.geo_index), size / 1024 / 1024))
 
     def import_country(self):
         print('Importing country data...')
@@ -242,15 +730,15 @@ class Command(BaseCommand):
         if uptodate and not self.force:
             return
         data = self.get_data('country')
-        s = 'Importing country data from {0} country datasets...'
-        print(s.format(len(data)))
-        cnt = 0
+        writer = BatchWriter('import_country', Country, self.batch_size,
+                             ['name', 'code', 'population', 'continent',
+                              'tld'])
         for items in self.parse(data):
-            cnt += 1
             country = Country()
             try:
                 country.id = int(items[16])  # geoname_id
-            except:
+            except (IndexError, ValueError):
+                self.stage.skip('no geoname_id')
                 continue  # skip the row if no geoname_id.
             country.name = items[4]
             # country.slug = slugify(country.name)
@@ -258,8 +746,9 @@ class Command(BaseCommand):
             country.population = items[7]
             country.continent = items[8]
             country.tld = items[9][1:]  # strip the leading .
-            country.save()
-        print('{} countries imported.'.format(cnt))
+            writer.upsert(country)
+            self.stage.row()
+        writer.close()
 
     def import_region(self):
         uptodate = self.download('region')
@@ -267,11 +756,11 @@ class Command(BaseCommand):
             return
         data = self.get_data('region')
         self.build_country_index()
-        cnt = 0
+        writer = BatchWriter('import_region', Region, self.batch_size,
+                             ['name', 'code', 'country'])
         print('Importing region data ...')
 
         for items in self.parse(data):
-            cnt += 1
             region = Region()
             region.id = int(items[3])  # geoname_id
             region.code = items[0]
@@ -281,11 +770,12 @@ class Command(BaseCommand):
             country_code = region.code.split('.')[0]
             try:
                 region.country = self.country_index[country_code]
-                region.save()
-            except:
-                s = 'Skip region "{0}", no related country found!'
-                print(s.format(region.code))
-        print('{0} regions imported.'.format(cnt))
+            except KeyError:
+                self.stage.skip('no country')
+                continue
+            writer.upsert(region)
+            self.stage.row()
+        writer.close()
 
     def import_city(self):
         uptodate = self.download_once('city')
@@ -294,61 +784,62 @@ class Command(BaseCommand):
         data = self.get_data('city')
         self.build_country_index()
         self.build_region_index()
-        cnt = 0
+        writer = BatchWriter('import_city', City, self.batch_size,
+                             ['name', 'lat', 'lng', 'cell', 'population',
+                              'timezone', 'country', 'region'])
         print('Importing city data ...')
 
         for items in self.parse(data):
-            cnt += 1
-            type = items[7]
-            if type not in conf['CITY_TYPES']:
-                continue
-
-            city = City()
-            city.id = int(items[0])  # geoname_id
-            city.name = items[1]  # Real name
-            city.lat = float(items[4])  # latitude in decimal degrees (wgs84)
-            city.lng = float(items[5])  # longitude in decimal degrees (wgs84)
-            city.population = items[14]
-
-            # Find country
-            try:
-                city.country = self.country_index[items[8]]
-            except:
-                print('Skip city "{0}", no related country found!'
-                      .format(city.id))
-                continue
-
-            # Find region
-            try:
-                rc = '{0}.{1}'.format(items[8].upper(), items[10])
-                city.region = self.region_index[rc]
-            except:
-                print('Skip city "{0}", no related region found!'
-                      .format(city.id))
-                continue
-
-            city.save()
-        print('{0} cities imported.'.format(cnt))
+            city = self.city_from_items(items)
+            if city is not None:
+                writer.upsert(city)
+                self.stage.row()
+        writer.close()
+        City.reset_index()
+
+    def city_from_items(self, items):
+        """Return an unsaved City from the items of a geoname row, or None
+        if the row is skipped."""
+        type = items[7]
+        if type not in conf['CITY_TYPES']:
+            self.stage.skip('feature code')
+            return None
+
+        city = City()
+        city.id = int(items[0])  # geoname_id
+        city.name = items[1]  # Real name
+        city.lat = float(items[4])  # latitude in decimal degrees (wgs84)
+        city.lng = float(items[5])  # longitude in decimal degrees (wgs84)
+        city.cell = cell_id(city.lat, city.lng)  # spatial cell id
+        city.population = items[14]
+        city.timezone = items[17]
+
+        # Find country
+        try:
+            city.country = self.country_index[items[8]]
+        except KeyError:
+            self.stage.skip('no country')
+            return None
+
+        # Find region
+        try:
+            rc = '{0}.{1}'.format(items[8].upper(), items[10])
+            city.region = self.region_index[rc]
+        except KeyError:
+            self.stage.skip('no region')
+            return None
+        return city
 
     def import_alt_name(self):
-        i = 0
-
         # Download the altnames file if necessary and fetch the data.
         uptodate = self.download('alt_name')
         if uptodate and not self.force:
             return
 
-        print('Fetching fresh alt_name data...')
-        data = self.get_data('alt_name')
-        print('Successfully fetched alt_name data.')
-
         # Import only names in the languages set in settings.LANGUAGES
         languages = [e[0] for e in settings.LANGUAGES]
         print('Looking for languages: {0}'.format(languages))
 
-        # The geo types used.
-        types = ((1, 'country'), (2, 'region'), (3, 'city'))
-
         # Load only geoname_id numbers from country, region, city into memory.
         print('Building indexes...')
         self.build_geo_index()
@@ -356,62 +847,67 @@ class Command(BaseCommand):
         self.build_region_index()
         print('All indexes built.')
 
-        print('Start importing of AltName data.')
-        for items in self.parse(data):
-            i += 1
-            print('{} import geoname_id "{}" for language {}'
-                  .format(i, items[1], items[2]), end=" ")
-
-            # Verify that the "name" items[3] contains a string:
-            item_name = items[3].strip()
-            if not item_name:
-                print('SKIP: Item had an empty strng for a name.')
-                continue
-
-            # Only get names for languages in use.
-            if items[2] not in languages:
-                print('SKIP: Unknown language.')
-                continue
-
-            # The geoname_id of the item.
-            item_geoname_id = int(items[1])
-            if not item_geoname_id:
-                print('SKIP: Item had an empty strng for a name.')
-                continue
+        print('Start importing of AltName data with {0} processes.'
+              .format(self.workers))
+        # Names of an earlier import are updated in place, matched by
+        # their alternateNameId. is_main, crc and the city values are kept.
+        writer = BatchWriter('import_alt_name', AltName, self.batch_size,
+                             ALT_NAME_FIELDS[1:], key='alternatename_id')
+        # Start the workers before the reader thread of get_data(), they
+        # are forked, so they get the geo index without copying it.
+        pool = None
+        if self.workers > 1:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                raise CommandError('--workers > 1 needs fork().')
+            pool = context.Pool(self.workers, init_alt_name_worker,
+                                (set(languages), self.geo_index))
+        else:
+            init_alt_name_worker(set(languages), self.geo_index)
 
-            # Find type (city, region, or country) for the item. Must be one
-            # of the three types defined above.
-            item_type = None
-            for t in types:
-                # The geo_index contains all geoname_id vals by type.
-                if item_geoname_id in self.geo_index[t[1]]:
-                    # Remember "types" id (city, region, coutnry) of the item.
-                    item_type = t[0]
-                    break
-            if item_type is None:
-                print('SKIP: Geoname type not found.')
-                continue
-            print('type "{}"'.format(item_type), end=' ')
-
-            # All import data clean, create database object.
-            alt = AltName()
-            # Use altname_id from source database as pk. Not useful, because
-            # the pk is actually never used hereafter.
-            # alt.id = int(items[0])
-            # The important identifier, the geoname_id of the geo object.
-            alt.geoname_id = item_geoname_id
-            alt.language = items[2]
-            alt.crc = ''
-            alt.name = item_name  # items[3]
-            alt.slug = slugify(item_name)
-            alt.type = item_type
-            alt.is_main = bool(0)
-            alt.is_preferred = bool(items[4])
-            alt.is_short = bool(items[5])
-            alt.is_colloquial = bool(items[6])
-            alt.is_historic = bool(items[7])
-            alt.save()
-            print('SAVED!')
+        print('Fetching fresh alt_name data...')
+        data = self.get_data('alt_name')
+        # Blocks of lines are parsed by the workers, and their rows are
+        # written here in the order of the blocks, so the result is the
+        # same as with a single process.
+        blocks = iter(lambda: list(itertools.islice(
+            data, conf['PARSE_BLOCK_SIZE'])), [])
+        if pool is not None:
+            results = map_ordered(pool, transform_alt_names, blocks,
+                                  2 * self.workers)
+        else:
+            results = map(transform_alt_names, blocks)
+        try:
+            for rows, skipped in results:
+                for values in rows:
+                    writer.upsert(
+                        AltName(**dict(zip(ALT_NAME_FIELDS, values))))
+                self.stage.add(len(rows), skipped)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        writer.close()
+
+        # Rows without an alternateNameId come from a dump of an older
+        # version or from fillup_alt_name, which adds them again. They
+        # are removed so that the upserted names take their place.
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {0} WHERE alternatename_id IS NULL'
+                           .format(connection.ops.quote_name(
+                               AltName._meta.db_table)))
+            print('import_alt_name: {0} rows without an alternateNameId '
+                  'removed.'.format(cursor.rowcount))
+
+    def altname_from_items(self, items, languages):
+        """Return an unsaved AltName from the items of an alternate name
+        row, or None if the row is skipped."""
+        values = parse_alt_name(items, languages, self.geo_index)
+        if isinstance(values, str):
+            self.stage.skip(values)
+            return None
+        return AltName(**dict(zip(ALT_NAME_FIELDS, values)))
 
     def fillup_alt_name(self):
         """
@@ -428,46 +924,59 @@ class Command(BaseCommand):
         and never query the names from (country, region, city).
         """
         languages = [e[0] for e in settings.LANGUAGES]
-        types = ((1, 'country'), (2, 'region'), (3, 'city'))
-        alt = AltName.objects.all()
-        obj = {'country': Country.objects.all(),
-               'region': Region.objects.all(),
-               'city': City.objects.all(), }
-
-        for t in types:
-            for c in obj[t[1]]:
-                for lg in languages:
-                    print('[t={0}] [c={1}] [lg={2}] Check entry for "{3}"...'
-                          .format(t[1], c.id, lg, c.name))
-                    for e in alt:
-                        if e.geoname_id == c.id and e.language == lg:
-                            print('Entry found with AltName id [{0}] as "{1}".'
-                                  .format(e.id, e.name))
-                            break
-                    else:
-                        # No entries, add one.
-                        print('NO entry found, so add one...')
-                        addalt = AltName()
-                        addalt.geoname_id = c.id
-                        addalt.language = lg
-                        addalt.crc = ''
-                        addalt.name = c.name
-                        addalt.slug = slugify(c.name)
-                        addalt.type = t[0]
-                        addalt.is_main = False
-                        addalt.is_preferred = True
-                        addalt.is_short = True
-                        addalt.is_colloquial = False
-                        addalt.is_historic = False
-
-                        if t == 2 or t == 3:
-                            # If this is a city or region, find the country
-                            addalt.country_id = c.country_id
-                            if t == 3:
-                                # If this is a city, also find the region.
-                                addalt.region_id = c.region_id
-                        addalt.save()
-                        print('New entry added for "{0}".'.format(c.name))
+        # The fields to read per type, with the country and region ids
+        # that are copied onto city and region AltNames.
+        types = ((1, Country, ('id', 'name')),
+                 (2, Region, ('id', 'name', 'country_id')),
+                 (3, City, ('id', 'name', 'country_id', 'region_id')))
+        writer = BatchWriter('fillup_alt_name', AltName, self.batch_size)
+
+        # All (geoname_id, language) pairs that already have an entry.
+        print('Loading existing AltName entries...')
+        existing = set()
+        for rows in self.restrict(AltName.objects.order_by()
+                                  .filter(language__in=languages)
+                                  .values_list('geoname_id', 'language')
+                                  .distinct()):
+            existing.update(rows.iterator())
+        print('{0} existing entries found.'.format(len(existing)))
+
+        for type, model, fields in types:
+            for rows in self.restrict(model.objects.order_by()
+                                      .values_list(*fields), 'pk'):
+                self.fillup_rows(writer, type, rows, existing, languages)
+        writer.close()
+
+    def fillup_rows(self, writer, type, rows, existing, languages):
+        """Add a name in every language that has none yet, for the
+        (geoname_id, name[, country_id[, region_id]]) rows of a type."""
+        for row in rows.iterator():
+            geoname_id, name = row[0], row[1]
+            for lg in languages:
+                if (geoname_id, lg) in existing:
+                    self.stage.skip('exists')
+                    continue
+                # No entries, add one.
+                addalt = AltName()
+                addalt.geoname_id = geoname_id
+                addalt.language = lg
+                addalt.crc = ''
+                addalt.name = name
+                addalt.slug = slugify(name)
+                addalt.type = type
+                addalt.is_main = False
+                addalt.is_preferred = True
+                addalt.is_short = True
+                addalt.is_colloquial = False
+                addalt.is_historic = False
+                if type == 2 or type == 3:
+                    # If this is a city or region, set the country.
+                    addalt.country_id = row[2]
+                    if type == 3:
+                        # If this is a city, also set the region.
+                        addalt.region_id = row[3]
+                writer.add(addalt)
+                self.stage.row()
 
     def define_main_alt_names(self):
         """
@@ -479,100 +988,190 @@ class Command(BaseCommand):
         """
         # Only for laguages that will be used, as defined in settings.LANGUAGES
         lgs = [e[0] for e in settings.LANGUAGES]
-
-        def try_to_set_main(lg, go):
-            try:
-                # 0: Check if item has already a main set with this geoname_id
-                # and language.
-                anlist = AltName.objects.filter(language=lg,
-                                                geoname_id=go.id, is_main=True)
-                cnt = anlist.count()
-                if cnt == 1:
-                    print('Already EXIST main for {0}, {1}'
-                          .format(lg, go.name))
-                    return True
-                elif cnt > 1:
-                    print('ERROR: more than one main for {0}, {1}'
-                          .format(lg, go.name))
-                    for an in anlist:
-                        an.is_main = False
-                        an.save()
-                    print('ERROR FIXED. Trying again to find main...')
-            except:
-                pass
-
-            try:
-                # Try 1: Only works if there is only one single object with
-                # this geoname_id and language.
-                an = AltName.objects.get(language=lg, geoname_id=go.id)
-                an.is_main = True
-                an.save()
-                print('Setting main for {0}--{1} to {2}'
-                      .format(lg, go.name, an.name))
-                return True
-            except:
-                pass
-
-            try:
-                # Try 2: Fetch the first available "short" name for the geoname
-                # object. Like USA for United States of America or Hamburg for
-                # Freie- und Hansestadt Hamburg, etc. If there is no short
-                # name, this would fail.
-                an = AltName.objects.filter(language=lg,
-                                            geoname_id=go.id, is_short=1)[0]
-                an.is_main = True
-                an.save()
-                print('Setting main for {0}--{1} to {2}'
-                      .format(lg, go.name, an.name))
-                return True
-            except:
-                pass
-
-            try:
-                # Try 3: Fetch the first "preferred" name for the object or
-                # fail if there is no preferred name.
-                an = AltName.objects.filter(language=lg, geoname_id=go.id,
-                                            is_preferred=1)[0]
-                an.is_main = True
-                an.save()
-                print('Setting main for {0}--{1} to {2}'
-                      .format(lg, go.name, an.name))
-                return True
-            except:
-                pass
-
-            try:
-                # Try 4: Finally, just fetch the first of any names for this
-                # object and set it as the default name. If this fails, too,
-                # then this geoname object is not in the AltName table (which
-                # would be odd, because we just added all of them).
-                an = AltName.objects.filter(language=lg, geoname_id=go.id)[0]
-                an.is_main = True
-                an.save()
-                print('Setting main for {0}--{1} to {2}'
-                      .format(lg, go.name, an.name))
-                return True
-            except:
-                pass
-
-            print('FAIL: Could not set "is_main" for {0}--{1} !'
-                  .format(lg, go.name))
-            return False
-
-        # Set a main AltName for each country name.
-        for go in Country.objects.all():
-            for lg in lgs:
-                try_to_set_main(lg, go)
-
-        # Set a main AltName for each region name.
-        for go in Region.objects.all():
-            for lg in lgs:
-                try_to_set_main(lg, go)
-
-        # Set a main AltName for each city name.
-        for go in City.objects.all():
-            for lg in lgs:
-                try_to_set_main(lg, go)
+        writer = BatchWriter('define_main_alt_names', AltName,
+                             self.batch_size, ['is_main'])
+        self.build_geo_index()
+        summary = {'existing': 0, 'conflicts': 0, 'sole': 0, 'short': 0,
+                   'preferred': 0, 'common': 0, 'first': 0, 'failures': 0}
+
+        def elect_main(rows):
+            # Return the row to become main and the rule that elected it:
+            # the only name, else the first "short" name (like USA for
+            # United States of America or Hamburg for Freie- und Hansestadt
+            # Hamburg), else the first "preferred" name, else the first
+            # name that is not colloquial, else the first.
+            if len(rows) == 1:
+                return rows[0], 'sole'
+            for rule in ('short', 'preferred'):
+                for row in rows:
+                    if row[rule]:
+                        return row, rule
+            for row in rows:
+                if not row['colloquial']:
+                    return row, 'common'
+            return rows[0], 'first'
+
+        for lg in lgs:
+            # One pass over all names in this language, grouped by geo object.
+            rows = AltName.objects.filter(language=lg).order_by(
+                'geoname_id', 'crc', 'pk').values(
+                'pk', 'geoname_id', 'is_main', 'is_short', 'is_preferred',
+                'is_colloquial')
+            rows = ({'pk': e['pk'], 'geoname_id': e['geoname_id'],
+                     'main': e['is_main'], 'short': e['is_short'],
+                     'preferred': e['is_preferred'],
+                     'colloquial': e['is_colloquial']}
+                    for qs in self.restrict(rows) for e in qs.iterator())
+            seen = set()
+            for geoname_id, group in itertools.groupby(
+                    rows, key=lambda e: e['geoname_id']):
+                if geoname_id not in self.geo_index:
+                    self.stage.skip('geoname type')
+                    continue
+                seen.add(geoname_id)
+                self.stage.row()
+                group = list(group)
+                mains = [e for e in group if e['main']]
+                if len(mains) == 1:
+                    summary['existing'] += 1
+                    continue
+                if len(mains) > 1:
+                    # More than one main, unset all and elect again.
+                    summary['conflicts'] += 1
+                    for e in mains:
+                        writer.change(AltName(pk=e['pk'], is_main=False))
+                main, rule = elect_main(group)
+                summary[rule] += 1
+                writer.change(AltName(pk=main['pk'], is_main=True))
+
+            for geoname_id in self.geo_index:
+                if geoname_id not in seen and (self.affected is None or
+                                               geoname_id in self.affected):
+                    summary['failures'] += 1
+        writer.close()
+        print('define_main_alt_names: {0}'.format(', '.join(
+              '{0}={1}'.format(k, v) for k, v in sorted(summary.items()))))
+        return summary
+
+    def build_read_model(self):
+        """Rebuild the LocalizedPlace table that the API views read from."""
+        print('Building LocalizedPlace read model...')
+        self.stage.rows = readmodel.rebuild(self.batch_size)
+
+    def refresh_read_model(self):
+        """Replace the LocalizedPlace rows of the changed geo objects."""
+        print('Refreshing LocalizedPlace rows of {0} geo objects...'.format(
+              len(self.affected)))
+        self.stage.rows = readmodel.refresh(self.affected, self.batch_size)
+
+    def apply_deletes(self):
+        """Delete the cities of the daily deletes file, with all their
+        AltNames."""
+        ids = [int(items[0]) for items in self.get_diff('deletes')]
+        deleted = set()
+        with transaction.atomic():
+            for chunk in chunked(ids, self.batch_size):
+                found = set(City.objects.filter(pk__in=chunk)
+                            .values_list('pk', flat=True))
+                AltName.objects.filter(type=3, geoname_id__in=found).delete()
+                City.objects.filter(pk__in=found).delete()
+                deleted |= found
+        for geoname_id in ids:
+            if geoname_id in deleted:
+                self.stage.row()
+            else:
+                self.stage.skip('not a city')
+        self.affected |= deleted
+        City.reset_index()
+
+    def apply_modifications(self):
+        """Add or update the cities of the daily modifications file.
+
+        Rows of existing cities are always applied. Other rows are added
+        only if they are cities that would be in cities15000. Countries and
+        regions are only imported from their own files.
+        """
+        rows = self.get_diff('modifications')
+        self.build_country_index()
+        self.build_region_index()
+        existing = set()
+        for chunk in chunked([int(e[0]) for e in rows], self.batch_size):
+            existing.update(City.objects.filter(pk__in=chunk)
+                            .values_list('pk', flat=True))
+        writer = BatchWriter('apply_modifications', City, self.batch_size,
+                             ['name', 'lat', 'lng', 'cell', 'population',
+                              'timezone', 'country', 'region'])
+        for items in rows:
+            if int(items[0]) not in existing:
+                if items[7] not in conf['CITY_TYPES']:
+                    self.stage.skip('not a city')
+                    continue
+                if int(items[14] or 0) < conf['CITY_MIN_POPULATION'] and \
+                        items[7] != 'PPLC':
+                    self.stage.skip('population')
+                    continue
+            city = self.city_from_items(items)
+            if city is not None:
+                writer.upsert(city)
+                self.affected.add(city.id)
+                self.stage.row()
+        writer.close()
+        City.reset_index()
+
+    def apply_alt_name_deletes(self):
+        """Delete the AltNames of the daily alternate names deletes file."""
+        ids = [int(items[0]) for items in self.get_diff('alt_name_deletes')]
+        found = 0
+        with transaction.atomic():
+            for chunk in chunked(ids, self.batch_size):
+                rows = AltName.objects.filter(alternatename_id__in=chunk)
+                geoname_ids = set(rows.values_list('geoname_id', flat=True))
+                found += rows.delete()[0]
+                self.affected |= geoname_ids
+        self.stage.rows = found
+        self.stage.skipped['not found'] = len(ids) - found
+
+    def apply_alt_name_modifications(self):
+        """Add or update the AltNames of the daily alternate names
+        modifications file. Existing names that no longer pass the
+        import filters, e.g. because their language changed, are
+        deleted."""
+        rows = self.get_diff('alt_name_modifications')
+        languages = [e[0] for e in settings.LANGUAGES]
+        self.build_geo_index()
+        # The pk and geoname_id of existing rows, by alternateNameId.
+        existing = {}
+        for chunk in chunked([int(e[0]) for e in rows], self.batch_size):
+            existing.update((e[0], e[1:]) for e in AltName.objects.filter(
+                alternatename_id__in=chunk).values_list(
+                'alternatename_id', 'pk', 'geoname_id'))
+        writer = BatchWriter('apply_alt_name_modifications', AltName,
+                             self.batch_size,
+                             ['geoname_id', 'language', 'name', 'slug',
+                              'type', 'is_preferred', 'is_short',
+                              'is_colloquial', 'is_historic'])
+        stale = []
+        for items in rows:
+            old = existing.get(int(items[0]))
+            if old is not None:
+                # The geo object the name belonged to changes too.
+                self.affected.add(old[1])
+            alt = self.altname_from_items(items, languages)
+            if alt is None:
+                if old is not None:
+                    stale.append(old[0])
+                continue
+            if old is None:
+                writer.add(alt)
+            else:
+                alt.pk = old[0]
+                writer.change(alt)
+            self.affected.add(alt.geoname_id)
+            self.stage.row()
+        writer.close()
+        for chunk in chunked(stale, self.batch_size):
+            AltName.objects.filter(pk__in=chunk).delete()
+        print('{0} AltNames deleted.'.format(len(stale)))
 
     def make_crc_for_main_alt_names(self):
         """
@@ -591,41 +1190,66 @@ class Command(BaseCommand):
         # Add a country and region ID and crc to all "main" city (3) types
         # in the AltName table.
         print('----- make_crc_for_main_alt_names() -----')
-        i = 0
-        for obj in AltName.objects.filter(type=3, is_main=True).order_by('pk'):
-            i += 1
-
-            # Get the related City object.
-            city = City.objects.get(pk=obj.geoname_id)
-            print('{0}--Processing city {4} "{1}" (country {2}, region {3})...'
-                  .format(i, city.name, city.country.id,
-                          city.region.id, city.id))
+        writer = BatchWriter('make_crc_for_main_alt_names', AltName,
+                             self.batch_size, ['country', 'region', 'crc',
+                                               'search', 'url', 'lat', 'lng',
+                                               'timezone', 'population'])
+
+        # The commonly used ("main") names and their slugs of all countries
+        # and regions, by (type, geoname_id, language). So the "City, Region,
+        # Country" string will all be in the same language.
+        names = {}
+        rows = AltName.objects.filter(type__in=(1, 2), is_main=True)\
+                              .order_by().values_list('type', 'geoname_id',
+                                                      'language', 'name')
+        for type, geoname_id, language, name in rows.iterator():
+            names[(type, geoname_id, language)] = (name, slugify(name))
+        print('{0} main country and region names loaded.'.format(len(names)))
+
+        # The country and region ids and the values that are copied onto
+        # the AltName of all cities.
+        # On an incremental import, the cities of changed countries and
+        # regions get new crc and url strings too.
+        if self.affected is not None:
+            for field in ('country_id', 'region_id'):
+                for rows in self.restrict(City.objects.order_by()
+                                          .values_list('pk', flat=True),
+                                          field):
+                    self.affected.update(rows.iterator())
+        cities = {}
+        for rows in self.restrict(City.objects.order_by().values_list(
+                'pk', 'country_id', 'region_id', 'lat', 'lng', 'timezone',
+                'population'), 'pk'):
+            cities.update((row[0], row[1:]) for row in rows.iterator())
+        print('{0} cities loaded.'.format(len(cities)))
+
+        rows = AltName.objects.filter(type=3, is_main=True).order_by('pk')\
+                              .values_list('pk', 'geoname_id', 'language',
+                                           'name')
+        rows = itertools.chain.from_iterable(
+            qs.iterator() for qs in self.restrict(rows))
+        for pk, geoname_id, language, name in rows:
+            try:
+                country_id, region_id, lat, lng, timezone, population = \
+                    cities[geoname_id]
+                country = names[(1, country_id, language)]
+                region = names[(2, region_id, language)]
+            except KeyError:
+                self.stage.skip('no city, region or country name')
+                continue
 
             # Set this AltName's values from the City object. This will help to
             # do faster lookups from user input.
-            obj.country_id = city.country.id
-            obj.region_id = city.region.id
-            obj.lat = city.lat
-            obj.lng = city.lng
-
-            # For this City object, find the commonly used ("main") names of
-            # its region and country, in the AltName object's language. So the
-            # "City, Region, Country" string will all be in the same language.
-            country = AltName.objects.get(type=1, geoname_id=obj.country.id,
-                                          is_main=True, language=obj.language)
-            region = AltName.objects.get(type=2, geoname_id=obj.region.id,
-                                         is_main=True, language=obj.language)
-
+            obj = AltName(pk=pk, country_id=country_id, region_id=region_id,
+                          lat=lat, lng=lng, timezone=timezone,
+                          population=population)
             # Build the "City, Region, Country" string ("crc").
-            obj.crc = '{0}, {1}, {2}'.format(obj.name, region.name,
-                                             country.name)[:200]
-            print('crc "{0}"...'.format(obj.crc))
-
+            obj.crc = '{0}, {1}, {2}'.format(name, region[0],
+                                             country[0])[:200]
+            obj.search = make_search_key(obj.crc)[:200]
             # Build the "country/region/city" URL path ("url").
-            obj.url = '{0}/{1}/{2}'.format(slugify(country.name),
-                                           slugify(region.name),
-                                           slugify(obj.name))[:100]
-            print('url "{0}"...'.format(obj.url))
-
-            obj.save()
-            print('done.')
+            obj.url = '{0}/{1}/{2}'.format(country[1], region[1],
+                                           slugify(name))[:100]
+            writer.change(obj)
+            self.stage.row()
+        writer.close()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+# A copy of dtrcity.models.make_search_key() as it was when this
+# migration was written, so later changes to it do not change the
+# migration.
+SEARCH_KEY_LETTERS = str.maketrans({
+    'ø': 'o', 'Ø': 'o', 'æ': 'ae', 'Æ': 'ae', 'œ': 'oe', 'Œ': 'oe',
+    'ł': 'l', 'Ł': 'l', 'đ': 'd', 'Đ': 'd', 'ð': 'd', 'Ð': 'd',
+    'þ': 'th', 'Þ': 'th', 'ı': 'i'})
+SEARCH_KEY_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def make_search_key(s):
+    s = unicodedata.normalize('NFKD', s.translate(SEARCH_KEY_LETTERS))
+    s = ''.join(c for c in s if not unicodedata.combining(c)).casefold()
+    return SEARCH_KEY_SEPARATORS.sub(' ', s).strip()
+
+
+def fill_search(apps, schema_editor):
+    AltName = apps.get_model('dtrcity', 'AltName')
+    for an in AltName.objects.exclude(crc='').only('pk', 'crc').iterator():
+        AltName.objects.filter(pk=an.pk).update(
+            search=make_search_key(an.crc)[:200])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='altname',
+            name='search',
+            field=models.CharField(default='', max_length=200),
+        ),
+        migrations.RunPython(fill_search, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from dtrcity.spatial import cell_id
+
+
+def fill_cell(apps, schema_editor):
+    City = apps.get_model('dtrcity', 'City')
+    for pk, lat, lng in City.objects.values_list('pk', 'lat', 'lng').iterator():
+        City.objects.filter(pk=pk).update(cell=cell_id(lat, lng))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0002_altname_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='cell',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(fill_cell, migrations.RunPython.noop),
+    ]
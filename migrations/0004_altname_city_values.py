@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_city_values(apps, schema_editor):
+    AltName = apps.get_model('dtrcity', 'AltName')
+    City = apps.get_model('dtrcity', 'City')
+    for city in City.objects.iterator():
+        AltName.objects.filter(geoname_id=city.pk, type=3, is_main=True)\
+            .update(lat=city.lat, lng=city.lng, timezone=city.timezone,
+                    population=city.population)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0003_city_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='altname',
+            name='lat',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='altname',
+            name='lng',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='altname',
+            name='population',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='altname',
+            name='timezone',
+            field=models.CharField(default='', max_length=40),
+        ),
+        migrations.AlterIndexTogether(
+            name='altname',
+            index_together=set([('language', 'crc', 'is_main'), ('geoname_id', 'language', 'is_main'), ('country', 'language', 'is_main')]),
+        ),
+        migrations.RunPython(fill_city_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_localized_places(apps, schema_editor):
+    AltName = apps.get_model('dtrcity', 'AltName')
+    LocalizedPlace = apps.get_model('dtrcity', 'LocalizedPlace')
+    batch = []
+    for an in AltName.objects.filter(is_main=True).iterator():
+        batch.append(LocalizedPlace(
+            type=an.type, geoname_id=an.geoname_id, language=an.language,
+            crc=an.crc, search=an.search, url=an.url, name=an.name,
+            slug=an.slug, country_id=an.country_id, region_id=an.region_id,
+            lat=an.lat, lng=an.lng, timezone=an.timezone,
+            population=an.population))
+        if len(batch) >= 1000:
+            LocalizedPlace.objects.bulk_create(batch)
+            batch = []
+    LocalizedPlace.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0004_altname_city_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocalizedPlace',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.PositiveSmallIntegerField(choices=[(1, 'country'), (2, 'region'), (3, 'city')])),
+                ('geoname_id', models.PositiveIntegerField()),
+                ('language', models.CharField(max_length=6)),
+                ('crc', models.CharField(default='', max_length=200)),
+                ('search', models.CharField(default='', max_length=200)),
+                ('url', models.CharField(db_index=True, default='', max_length=100)),
+                ('name', models.CharField(default='', max_length=200)),
+                ('slug', models.SlugField(db_index=False, default='', max_length=200)),
+                ('country_id', models.PositiveIntegerField(default=None, null=True)),
+                ('region_id', models.PositiveIntegerField(default=None, null=True)),
+                ('lat', models.FloatField(default=0.0)),
+                ('lng', models.FloatField(default=0.0)),
+                ('timezone', models.CharField(default='', max_length=40)),
+                ('population', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['crc'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='localizedplace',
+            unique_together=set([('type', 'geoname_id', 'language')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='localizedplace',
+            index_together=set([('type', 'language', 'country_id', 'population')]),
+        ),
+        migrations.RunPython(fill_localized_places, migrations.RunPython.noop),
+    ]
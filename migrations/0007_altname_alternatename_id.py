@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0006_dataset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='altname',
+            name='alternatename_id',
+            field=models.PositiveIntegerField(db_index=True, default=None, null=True),
+        ),
+    ]
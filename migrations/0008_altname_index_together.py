@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrcity', '0007_altname_alternatename_id'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='altname',
+            index_together=set([('language', 'crc', 'is_main'), ('geoname_id', 'language', 'is_main')]),
+        ),
+    ]
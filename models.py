@@ -1,15 +1,78 @@
+import calendar
 import math
+import os
+import re
+import threading
+import unicodedata
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.timezone import is_naive, make_aware, now
 from django.utils.text import slugify
 from django.utils.translation import get_language
 
+from dtrcity.cache import dataset_version, main_altnames
+from dtrcity.spatial import EARTH_RADIUS_KM, CityGrid, KDTree, cell_id, \
+    cell_ranges
+
+try:
+    import numpy
+except ImportError:  # Optional, only needed for arrays of locations.
+    numpy = None
+
 # settings: Default distance around a city.
 DISTANCE_AROUND_CITY = getattr(settings, 'DISTANCE_AROUND_CITY', 20)
 # Semi-axes of WGS-84 geoidal reference
 WGS84_a = 6378137.0  # Major semiaxis [m]
 WGS84_b = 6356752.3  # Minor semiaxis [m]
+# Max. distance [km] from a lat/lng location to its nearest city.
+NEAREST_CITY_MAX_DISTANCE = 2000
+
+# Optional file with the precomputed nearest city grid, built with the
+# "build_city_grid" command. If set, nearest city lookups use the grid.
+CITY_GRID_FILE = getattr(settings, 'DTRCITY_CITY_GRID', None)
+
+# Process-local spatial index over all cities, as (dataset version,
+# KDTree), see City.get_index().
+_city_index = None
+_city_index_lock = threading.Lock()
+# Memory-mapped nearest city grid, as ((dataset version, file mtime),
+# CityGrid or None), see City.get_grid().
+_city_grid = None
+
+
+class ScalarMath(object):
+    # Math functions for single float values.
+    sin = staticmethod(math.sin)
+    cos = staticmethod(math.cos)
+    sqrt = staticmethod(math.sqrt)
+    asin = staticmethod(math.asin)
+    minimum = staticmethod(min)
+
+
+class ArrayMath(object):
+    # Math functions for NumPy arrays of values.
+    sin = staticmethod(getattr(numpy, 'sin', None))
+    cos = staticmethod(getattr(numpy, 'cos', None))
+    sqrt = staticmethod(getattr(numpy, 'sqrt', None))
+    asin = staticmethod(getattr(numpy, 'arcsin', None))
+    minimum = staticmethod(getattr(numpy, 'minimum', None))
+
+
+def as_values(*values):
+    """Return the math functions for the given values, and the values.
+
+    If NumPy is installed and any value is a list, tuple, or array, all
+    values are converted to float arrays and ArrayMath is returned, so
+    that the functions below work element-wise on arrays of locations.
+    """
+    if numpy is not None and any(isinstance(v, (list, tuple, numpy.ndarray))
+                                 for v in values):
+        return ArrayMath, [numpy.asarray(v, dtype=float) for v in values]
+    return ScalarMath, list(values)
 
 
 # calculate the bounding box for a given lat/lng location, from
@@ -17,34 +80,39 @@ WGS84_b = 6356752.3  # Minor semiaxis [m]
 #                       bounding-box-for-a-given-lat-lng-location
 def deg2rad(degrees):
     # degrees to radians
+    _, (degrees, ) = as_values(degrees)
     return math.pi * degrees / 180.0
 
 
 def rad2deg(radians):
     # radians to degrees
+    _, (radians, ) = as_values(radians)
     return 180.0 * radians / math.pi
 
 
 def WGS84EarthRadius(lat):
     # http://en.wikipedia.org/wiki/Earth_radius
     # Earth radius at a given latitude, according to the WGS-84 ellipsoid [m]
-    An = WGS84_a * WGS84_a * math.cos(lat)
-    Bn = WGS84_b * WGS84_b * math.sin(lat)
-    Ad = WGS84_a * math.cos(lat)
-    Bd = WGS84_b * math.sin(lat)
-    return math.sqrt((An*An + Bn*Bn) / (Ad*Ad + Bd*Bd))
+    m, (lat, ) = as_values(lat)
+    An = WGS84_a * WGS84_a * m.cos(lat)
+    Bn = WGS84_b * WGS84_b * m.sin(lat)
+    Ad = WGS84_a * m.cos(lat)
+    Bd = WGS84_b * m.sin(lat)
+    return m.sqrt((An*An + Bn*Bn) / (Ad*Ad + Bd*Bd))
 
 
 def boundingBox(latitudeInDegrees, longitudeInDegrees, halfSideInKm):
     # Bounding box surrounding the point at given coordinates, assuming local
     # approximation of Earth surface as a sphere of radius given by WGS84
+    m, (latitudeInDegrees, longitudeInDegrees, halfSideInKm) = as_values(
+        latitudeInDegrees, longitudeInDegrees, halfSideInKm)
     lat = deg2rad(latitudeInDegrees)
     lon = deg2rad(longitudeInDegrees)
     halfSide = 1000 * halfSideInKm
     # Radius of Earth at given latitude
     radius = WGS84EarthRadius(lat)
     # Radius of the parallel at given latitude
-    pradius = radius * math.cos(lat)
+    pradius = radius * m.cos(lat)
     latMin = lat - halfSide/radius
     latMax = lat + halfSide/radius
     lonMin = lon - halfSide/pradius
@@ -52,6 +120,71 @@ def boundingBox(latitudeInDegrees, longitudeInDegrees, halfSideInKm):
     return (rad2deg(latMin), rad2deg(lonMin), rad2deg(latMax), rad2deg(lonMax))
 
 
+def circleBox(lat, lng, dist):
+    """Return the (latmin, lngmin, latmax, lngmax) box in degrees that
+    contains all points within dist km of lat/lng, on the sphere that
+    haversine() uses. boundingBox() uses the larger WGS-84 radius and so
+    may cut off points near the circle."""
+    angle = dist / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    if abs(lat) + dlat >= 90 or angle >= math.pi / 2:
+        # The circle contains a pole, it may cover all longitudes.
+        return (max(lat - dlat, -90.0), -180.0, min(lat + dlat, 90.0), 180.0)
+    # The widest part of the circle is at a latitude nearer to the pole,
+    # so this is a little more than angle / cos(lat).
+    dlng = math.degrees(math.asin(min(1.0, math.sin(angle) /
+                                      math.cos(math.radians(lat)))))
+    return (lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Return the great-circle distance in km between lat1/lng1 and
+    lat2/lng2, in degrees. Any argument may be an array, the distances
+    are then returned as an array."""
+    m, (lat1, lng1, lat2, lng2) = as_values(lat1, lng1, lat2, lng2)
+    lat1, lng1, lat2, lng2 = (deg2rad(v) for v in (lat1, lng1, lat2, lng2))
+    a = (m.sin((lat2 - lat1) / 2) ** 2 +
+         m.cos(lat1) * m.cos(lat2) * m.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * m.asin(m.minimum(1.0, m.sqrt(a)))
+
+
+def in_cells(latmin, lngmin, latmax, lngmax):
+    """Return a Q object that limits City rows to the few cell id ranges
+    covering the box, so the box is read with index range scans on the
+    cell column instead of one scan over its whole latitude band."""
+    q = Q()
+    for first, last in cell_ranges(latmin, lngmin, latmax, lngmax):
+        q |= Q(cell__range=(first, last))
+    return q
+
+
+def distances(lat, lng, lats, lngs):
+    """Return a list with the distances in km from lat/lng to all
+    lats/lngs. Computed as one array if NumPy is installed."""
+    if numpy is not None:
+        return haversine(lat, lng, lats, lngs).tolist()
+    return [haversine(lat, lng, a, b) for a, b in zip(lats, lngs)]
+
+
+# Letters that have no decomposition into base letter and accent.
+SEARCH_KEY_LETTERS = str.maketrans({
+    'ø': 'o', 'Ø': 'o', 'æ': 'ae', 'Æ': 'ae', 'œ': 'oe', 'Œ': 'oe',
+    'ł': 'l', 'Ł': 'l', 'đ': 'd', 'Đ': 'd', 'ð': 'd', 'Ð': 'd',
+    'þ': 'th', 'Þ': 'th', 'ı': 'i'})
+# Runs of anything that is not a letter or digit.
+SEARCH_KEY_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def make_search_key(s):
+    """Return the accent and case insensitive form of s that is used to
+    search for it: diacritics stripped, casefolded, and any punctuation
+    collapsed into single spaces. "São Paulo, SP" becomes "sao paulo sp".
+    """
+    s = unicodedata.normalize('NFKD', s.translate(SEARCH_KEY_LETTERS))
+    s = ''.join(c for c in s if not unicodedata.combining(c)).casefold()
+    return SEARCH_KEY_SEPARATORS.sub(' ', s).strip()
+
+
 class Country(models.Model):
     """Model that describes all countries."""
 
@@ -68,13 +201,16 @@ class Country(models.Model):
     # Could be used to limit locations to large countries only.
     population = models.PositiveIntegerField(default=0)
 
+    # The AltName.type of this model.
+    altname_type = 1
+
     def __str__(self):
         return self.name
 
     def get_main_altname(self):
         """Return the main AltName object for this city, or None"""
-        return AltName.objects.filter(geoname_id=self.pk, is_main=True, type=1,
-                                      language=settings.LANGUAGE_CODE).first()
+        return get_main_altnames(1, [self.pk],
+                                 settings.LANGUAGE_CODE)[self.pk]
 
     @property
     def tr_name(self):
@@ -100,6 +236,9 @@ class Region(models.Model):
     # FIXME: add ", db_index=True" here!
     country = models.ForeignKey(Country, null=True, default=None)
 
+    # The AltName.type of this model.
+    altname_type = 2
+
     class Meta:
         ordering = ['country', 'name']
 
@@ -108,8 +247,8 @@ class Region(models.Model):
 
     def get_main_altname(self):
         """Return the main AltName object for this city, or None"""
-        return AltName.objects.filter(geoname_id=self.pk, is_main=True, type=2,
-                                      language=settings.LANGUAGE_CODE).first()
+        return get_main_altnames(2, [self.pk],
+                                 settings.LANGUAGE_CODE)[self.pk]
 
     @property
     def tr_name(self):
@@ -150,10 +289,15 @@ class City(models.Model):
     # latitude and longitude in decimal degrees (wgs84)
     lat = models.FloatField(default=0.0)
     lng = models.FloatField(default=0.0)
+    # Z-order spatial cell id of lat/lng, see spatial.cell_id().
+    cell = models.PositiveIntegerField(default=0, db_index=True)
     # These values may be missing for many cities.
     timezone = models.CharField(max_length=40, default='')
     population = models.PositiveIntegerField(default=0)
 
+    # The AltName.type of this model.
+    altname_type = 3
+
     class Meta:
         ordering = ['name']
         index_together = ['lat', 'lng']
@@ -161,10 +305,14 @@ class City(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.cell = cell_id(self.lat, self.lng)
+        super(City, self).save(*args, **kwargs)
+
     def get_main_altname(self):
         """Return the main AltName object for this city, or None"""
-        return AltName.objects.filter(geoname_id=self.pk, is_main=True, type=3,
-                                      language=settings.LANGUAGE_CODE).first()
+        return get_main_altnames(3, [self.pk],
+                                 settings.LANGUAGE_CODE)[self.pk]
 
     @property
     def tr_name(self):
@@ -215,43 +363,166 @@ class City(models.Model):
             return None
 
     @classmethod
-    def get_cities_around_city(cls, city, dist=None):
+    def get_many_by_crc(cls, names):
+        """Return a dict with the City object that matches each crc in
+        names, or None. Uses one AltName and one City query."""
+        return cls.get_many_by('crc', names)
+
+    @classmethod
+    def get_many_by_url(cls, names):
+        """Return a dict with the City object that matches each url in
+        names, or None. Uses one AltName and one City query."""
+        return cls.get_many_by('url', names)
+
+    @classmethod
+    def get_many_by(cls, field, names):
+        lang = get_language()[:2]
+        names = list(names)
+        geoname_ids = {}
+        rows = AltName.objects.filter(type=3, is_main=True, language=lang,
+                                      **{field + '__in': set(names)})
+        for name, geoname_id in rows.order_by('pk').values_list(
+                field, 'geoname_id'):
+            # Like get_by_crc() and get_by_url(), the first match wins.
+            geoname_ids.setdefault(name, geoname_id)
+        cities = City.objects.in_bulk(set(geoname_ids.values()))
+        return {name: cities.get(geoname_ids.get(name)) for name in names}
+
+    @classmethod
+    def get_cities_around_city(cls, city, dist=None, exact=False, limit=None):
         """Find all City objects within "dist" km from City, including City
-        itself. Uses a simple 'square', not a circle, for the surrounding."""
+        itself. Uses a simple 'square', not a circle, for the surrounding.
+
+        With exact=True, returns a list of the cities within a circle of
+        "dist" km instead, nearest first and at most "limit" of them. Each
+        City has a "distance" attribute in km. The square is used as a
+        prefilter in the database, then the distances of its cities are
+        computed in one pass."""
         if dist is None:
             # some default distance
             dist = DISTANCE_AROUND_CITY
-        latmin, lngmin, latmax, lngmax = boundingBox(city.lat, city.lng, dist)
-        return City.objects.filter(lat__gte=latmin, lng__gte=lngmin,
-                                   lat__lte=latmax, lng__lte=lngmax)
+        if exact:
+            # A box that contains the whole haversine() circle.
+            latmin, lngmin, latmax, lngmax = circleBox(city.lat, city.lng,
+                                                       dist)
+        else:
+            latmin, lngmin, latmax, lngmax = boundingBox(city.lat, city.lng,
+                                                         dist)
+        cities = City.objects.filter(in_cells(latmin, lngmin, latmax, lngmax),
+                                     lat__gte=latmin, lng__gte=lngmin,
+                                     lat__lte=latmax, lng__lte=lngmax)
+        if not exact:
+            return cities
+        rows = list(cities.order_by().values_list('pk', 'lat', 'lng'))
+        if not rows:
+            return []
+        pks, lats, lngs = zip(*rows)
+        dists = distances(city.lat, city.lng, lats, lngs)
+        hits = sorted((d, pk) for d, pk in zip(dists, pks) if d <= dist)
+        hits = hits[:limit] if limit is not None else hits
+        objs = City.objects.in_bulk([pk for d, pk in hits])
+        for d, pk in hits:
+            objs[pk].distance = d
+        return [objs[pk] for d, pk in hits]
 
     @classmethod
-    def get_cities_around_crc(cls, city_crc, dist=None):
+    def get_cities_around_crc(cls, city_crc, dist=None, exact=False,
+                              limit=None):
         """Shortcut, first finds the city, then the surrounding cities."""
         city = cls.get_by_crc(city_crc)
-        return cls.get_cities_around_city(city, dist)
+        return cls.get_cities_around_city(city, dist, exact, limit)
+
+    @classmethod
+    def get_index(cls):
+        """Return the process-local spatial index over all cities. It
+        is built from the City table on first use, and again when the
+        dataset version changed."""
+        global _city_index
+        version = dataset_version.get()[0]
+        index = _city_index
+        if index is None or index[0] != version:
+            # Only one thread builds the tree, the others wait for it.
+            with _city_index_lock:
+                index = _city_index
+                if index is None or index[0] != version:
+                    index = _city_index = (version, KDTree(
+                        cls.objects.order_by().values_list(
+                            'pk', 'lat', 'lng')))
+        return index[1]
+
+    @classmethod
+    def get_grid(cls):
+        """Return the memory-mapped nearest city grid, or None if the
+        DTRCITY_CITY_GRID setting is not set, or the file is missing or
+        older than the last import, so it may return deleted cities and
+        miss new ones. The file is mapped again when the dataset version
+        or the file changed."""
+        global _city_grid
+        if not CITY_GRID_FILE:
+            return None
+        version, updated = dataset_version.get()
+        try:
+            mtime = os.path.getmtime(CITY_GRID_FILE)
+        except OSError:
+            mtime = None
+        key = (version, mtime)
+        if _city_grid is None or _city_grid[0] != key:
+            grid = None
+            if updated is not None and is_naive(updated):
+                # USE_TZ is False, the time is in the local time zone.
+                updated = make_aware(updated)
+            if mtime is not None and (updated is None or mtime >=
+                                      calendar.timegm(updated.utctimetuple())):
+                grid = CityGrid(CITY_GRID_FILE)
+            _city_grid = (key, grid)
+        return _city_grid[1]
+
+    @classmethod
+    def reset_index(cls):
+        """Drop the spatial index and the grid, they are loaded again on
+        next use."""
+        global _city_index, _city_grid
+        _city_index = None
+        _city_grid = None
+
+    @classmethod
+    def nearest_pk(cls, lat, lng):
+        """Return the pk of the City nearest to the given lat/lng, or
+        None if there is no city within 2000 km from lat/lng."""
+        return cls.nearest_pks([(lat, lng)])[0]
+
+    @classmethod
+    def nearest_pks(cls, points):
+        """Return the pk of the nearest City, or None, for each lat/lng
+        pair in points. Uses the grid if there is a current one, else the
+        spatial index."""
+        grid = cls.get_grid()
+        if grid is not None:
+            nearest = grid.nearest
+        else:
+            index = cls.get_index()
+
+            def nearest(lat, lng):
+                hits = index.nearest(lat, lng)
+                return (hits[0][0], hits[0][1]) if hits else None
+        pks = []
+        for lat, lng in points:
+            hit = nearest(lat, lng)
+            if hit and hit[0] <= NEAREST_CITY_MAX_DISTANCE:
+                pks.append(hit[1])
+            else:
+                pks.append(None)
+        return pks
 
     @classmethod
     def by_latlng(cls, lat, lng):
         """Return the City nearest to the given lat/lng. Returns None
         if there is no city within 2000 km from lat/lng."""
-        # fetch some cities, first try near by
-        for dist in [10, 50, 100, 200, 500, 2000]:
-            latmin, lngmin, latmax, lngmax = boundingBox(lat, lng, dist)
-            cities = list(City.objects.filter(lat__gte=latmin, lng__gte=lngmin,
-                                              lat__lte=latmax, lng__lte=lngmax
-                                              ).values('pk', 'lat', 'lng'))
-            if len(cities) > 0:
-                # found some cities! find the nearest.
-                for city in cities:
-                    # simplefied: distance without accounting for earth radius.
-                    city['dist'] = math.sqrt(math.pow((lat - city['lat']), 2) +
-                                             math.pow((lng - city['lng']), 2))
-                # Sort to have the closest city first.
-                cities.sort(key=lambda c: c['dist'])
-                return City.objects.get(pk=cities[0]['pk'])
-        # unlikely but possible: no city in ~2000 km from lat/lng.
-        return None
+        pk = cls.nearest_pk(lat, lng)
+        if pk is None:
+            # unlikely but possible: no city in ~2000 km from lat/lng.
+            return None
+        return City.objects.get(pk=pk)
 
 
 class AltName(models.Model):
@@ -270,6 +541,11 @@ class AltName(models.Model):
     # for the different names of the same geoname object. It may be
     # the pk of a City, a Region, or a Country, depending on "type".
     geoname_id = models.PositiveIntegerField(db_index=True)
+    # The alternateNameId from the geoname database, used to apply the
+    # daily modifications. None for names copied from the country,
+    # region, or city by the importer.
+    alternatename_id = models.PositiveIntegerField(null=True, default=None,
+                                                   db_index=True)
     # For country names, these are empty. For region names only the
     # country is referenced. For city names, the city's Region and
     # Country are referenced.
@@ -281,6 +557,9 @@ class AltName(models.Model):
     # "City, Region, Country" string (only stored for "city" values.
     # In the language defined in the "language" field.
     crc = models.CharField(max_length=200, db_index=True, default='')
+    # The crc normalized with make_search_key(), used for autocomplete
+    # lookups from user input. Indexed together with the language.
+    search = models.CharField(max_length=200, default='')
     # "country/region/city" URL string, only stored for "city" values
     # with "is_main" field True and in the language defined in the
     # "language" field.
@@ -300,6 +579,13 @@ class AltName(models.Model):
     is_short = models.BooleanField(default=False)
     is_colloquial = models.BooleanField(default=False)
     is_historic = models.BooleanField(default=False)
+    # Copies of the City values, only stored for "city" values with
+    # "is_main" True, so that city data is read with the name in a
+    # single row fetch.
+    lat = models.FloatField(default=0.0)
+    lng = models.FloatField(default=0.0)
+    timezone = models.CharField(max_length=40, default='')
+    population = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ["crc"]
@@ -310,3 +596,117 @@ class AltName(models.Model):
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        # Expanded ligatures may make the key longer than the crc.
+        self.search = make_search_key(self.crc)[:200]
+        super(AltName, self).save(*args, **kwargs)
+
+
+class LocalizedPlace(models.Model):
+    """Read model with one row per geo object and language.
+
+    Holds a copy of the main AltName of every country, region and city,
+    together with the city values that the API returns, so that the API
+    views read a single table without joins. import_cities rebuilds it
+    from AltName at the end of every run, see dtrcity.readmodel.
+    """
+
+    # Type of geoname object. 1=countries, 2=regions, and 3=cities.
+    type = models.PositiveSmallIntegerField(choices=((1, 'country'),
+                                            (2, 'region'), (3, 'city')))
+    # The pk of the City, Region, or Country, depending on "type".
+    geoname_id = models.PositiveIntegerField()
+    language = models.CharField(max_length=6)
+    # Same as in AltName. Only set for cities.
+    crc = models.CharField(max_length=200, default='')
+    search = models.CharField(max_length=200, default='')
+    url = models.CharField(max_length=100, default='', db_index=True)
+    name = models.CharField(max_length=200, default='')
+    slug = models.SlugField(max_length=200, default='', db_index=False)
+    # Plain ids, no foreign keys, so that the table can be swapped.
+    country_id = models.PositiveIntegerField(null=True, default=None)
+    region_id = models.PositiveIntegerField(null=True, default=None)
+    lat = models.FloatField(default=0.0)
+    lng = models.FloatField(default=0.0)
+    timezone = models.CharField(max_length=40, default='')
+    population = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['crc']
+        unique_together = [['type', 'geoname_id', 'language']]
+        index_together = [['type', 'language', 'country_id', 'population']]
+
+    def __str__(self):
+        return self.name
+
+
+class Dataset(models.Model):
+    """The version of the imported geo data.
+
+    There is only one row. Every successful import_cities run bumps the
+    version, which is part of the keys and ETags of cached responses.
+    """
+
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(null=True, default=None)
+
+    def __str__(self):
+        return 'version {0}'.format(self.version)
+
+    @classmethod
+    def current(cls):
+        """Return the Dataset row, or an unsaved one at version 0."""
+        return cls.objects.order_by('pk').first() or cls()
+
+    @classmethod
+    def bump(cls):
+        """Increase the version and set the update time to now."""
+        with transaction.atomic():
+            obj = cls.objects.select_for_update().order_by('pk').first() \
+                or cls()
+            obj.version += 1
+            obj.updated = now()
+            obj.save()
+        dataset_version.clear()
+        return obj
+
+
+def get_main_altnames(type, geoname_ids, language):
+    """Return a dict with the main AltName, or None, of every geoname_id
+    of the given type and language. Only names not in the cache are
+    fetched, with a single query."""
+    keys = [(type, geoname_id, language) for geoname_id in geoname_ids]
+    found = main_altnames.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        loaded = dict.fromkeys(missing)
+        for an in AltName.objects.filter(
+                geoname_id__in=[key[1] for key in missing], is_main=True,
+                type=type, language=language):
+            loaded[(type, an.geoname_id, language)] = an
+        main_altnames.set_many(loaded)
+        found.update(loaded)
+    return {key[1]: found[key] for key in keys}
+
+
+def prefetch_main_altnames(objs, language=None):
+    """Load the main AltNames of a list or queryset of Country, Region,
+    or City objects into the cache with at most one query, so that their
+    tr_name and tr_slug are served without further queries. Returns the
+    objects as a list."""
+    objs = list(objs)
+    if objs:
+        if language is None:
+            language = settings.LANGUAGE_CODE
+        get_main_altnames(objs[0].altname_type, [e.pk for e in objs],
+                          language)
+    return objs
+
+
+@receiver(post_save, sender=AltName)
+@receiver(post_delete, sender=AltName)
+def altname_changed(sender, instance, **kwargs):
+    """Drop the cached main name of the AltName's geo object."""
+    main_altnames.delete((instance.type, instance.geoname_id,
+                          instance.language))
@@ -0,0 +1,104 @@
+"""
+Rebuild of the LocalizedPlace read model.
+
+The rows are written into a new table, which then replaces the live
+table by renaming both tables in one transaction. Readers therefore see
+either all old or all new rows, never a partly written table, and the
+rebuild does not lock the live table while it runs.
+
+After an incremental import, refresh() replaces only the rows of the
+changed geo objects, in place.
+"""
+
+import time
+
+from django.apps.registry import Apps
+from django.db import connection, models, transaction
+
+from dtrcity.models import AltName, LocalizedPlace
+
+# The LocalizedPlace fields and the AltName fields they are copied from.
+FIELDS = (
+    ('type', 'type'), ('geoname_id', 'geoname_id'), ('language', 'language'),
+    ('crc', 'crc'), ('search', 'search'), ('url', 'url'), ('name', 'name'),
+    ('slug', 'slug'), ('country_id', 'country'), ('region_id', 'region'),
+    ('lat', 'lat'), ('lng', 'lng'), ('timezone', 'timezone'),
+    ('population', 'population'),
+)
+
+
+def staging_model(suffix):
+    """Return a copy of the LocalizedPlace model on a new table, named
+    with the suffix, so its table and index names are unique. The model
+    has a registry of its own, so it is not added to the app registry."""
+    meta = LocalizedPlace._meta
+
+    class Meta:
+        apps = Apps()
+        app_label = meta.app_label
+        db_table = '{0}_{1}'.format(meta.db_table, suffix)
+        unique_together = meta.unique_together
+        index_together = meta.index_together
+
+    attrs = {'__module__': LocalizedPlace.__module__, 'Meta': Meta}
+    for field in meta.local_fields:
+        if not field.primary_key:
+            attrs[field.name] = field.clone()
+    return type('LocalizedPlace{0}'.format(suffix), (models.Model,), attrs)
+
+
+def rebuild(batch_size=1000):
+    """Fill a new table from the main AltNames and swap it in place of
+    the live LocalizedPlace table. Returns the number of rows."""
+    suffix = str(int(time.time() * 1000))
+    staging = staging_model(suffix)
+    live = LocalizedPlace._meta.db_table
+    staging_table = staging._meta.db_table
+    old_table = '{0}_old_{1}'.format(live, suffix)
+
+    with connection.schema_editor() as editor:
+        editor.create_model(staging)
+    try:
+        rows = AltName.objects.filter(is_main=True).order_by()\
+                              .values_list(*[e[1] for e in FIELDS])
+        names = [e[0] for e in FIELDS]
+        cnt = 0
+        batch = []
+        for row in rows.iterator():
+            batch.append(staging(**dict(zip(names, row))))
+            if len(batch) >= batch_size:
+                staging.objects.bulk_create(batch)
+                cnt += len(batch)
+                batch = []
+        staging.objects.bulk_create(batch)
+        cnt += len(batch)
+    except Exception:
+        with connection.schema_editor() as editor:
+            editor.delete_model(staging)
+        raise
+
+    with transaction.atomic():
+        with connection.schema_editor() as editor:
+            editor.alter_db_table(LocalizedPlace, live, old_table)
+            editor.alter_db_table(staging, staging_table, live)
+            editor.execute(editor.sql_delete_table % {
+                'table': editor.quote_name(old_table)})
+    return cnt
+
+
+def refresh(geoname_ids, batch_size=1000):
+    """Replace the live rows of the given geo objects with their current
+    main AltNames, in one transaction. Returns the number of rows."""
+    geoname_ids = sorted(geoname_ids)
+    names = [e[0] for e in FIELDS]
+    cnt = 0
+    with transaction.atomic():
+        for i in range(0, len(geoname_ids), batch_size):
+            chunk = geoname_ids[i:i + batch_size]
+            LocalizedPlace.objects.filter(geoname_id__in=chunk).delete()
+            rows = AltName.objects.filter(is_main=True, geoname_id__in=chunk)\
+                .order_by().values_list(*[e[1] for e in FIELDS])
+            batch = [LocalizedPlace(**dict(zip(names, row))) for row in rows]
+            LocalizedPlace.objects.bulk_create(batch)
+            cnt += len(batch)
+    return cnt
@@ -0,0 +1,68 @@
+"""
+JSON encoding for the API views.
+
+Uses the fastest encoder that is installed: orjson, then ujson, and the
+standard json module otherwise. Large lists can be streamed item by
+item, so that neither the list nor the whole JSON string is held in
+memory.
+"""
+
+import itertools
+import json
+import time
+
+from django.http import HttpResponse, StreamingHttpResponse
+
+from dtrcity.instrumentation import add_serialization_time
+
+try:
+    import orjson
+except ImportError:  # Optional, faster JSON encoder.
+    orjson = None
+try:
+    import ujson
+except ImportError:  # Optional, faster JSON encoder.
+    ujson = None
+
+# Number of list items encoded per chunk of a streamed response.
+STREAM_CHUNK_SIZE = 500
+
+
+def dumps(obj):
+    """Return obj encoded as JSON bytes."""
+    started = time.time()
+    if orjson is not None:
+        content = orjson.dumps(obj)
+    elif ujson is not None:
+        content = ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    else:
+        content = json.dumps(obj).encode('utf-8')
+    add_serialization_time(time.time() - started)
+    return content
+
+
+def iter_list(items):
+    """Yield the JSON bytes of a list with all items of an iterable, in
+    chunks of STREAM_CHUNK_SIZE items."""
+    items = iter(items)
+    sep = b'['
+    while True:
+        chunk = list(itertools.islice(items, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        # One call per chunk, without the brackets of the chunk's list.
+        yield sep + dumps(chunk)[1:-1]
+        sep = b','
+    yield b']' if sep == b',' else b'[]'
+
+
+def json_response(obj):
+    """Return an HttpResponse with obj as JSON."""
+    return HttpResponse(dumps(obj), content_type='application/json')
+
+
+def streaming_json_response(items):
+    """Return a StreamingHttpResponse with a JSON list of the items of
+    an iterable, e.g. a generator that reads rows page by page."""
+    return StreamingHttpResponse(iter_list(items),
+                                 content_type='application/json')
@@ -0,0 +1,261 @@
+"""
+Process-local spatial index for nearest city lookups.
+
+City coordinates are projected onto the unit sphere and stored in a
+3-d tree. The straight (chord) distance between two points on the
+sphere grows with their great-circle distance, so the nearest point in
+the tree is also the nearest city on the earth's surface, and a search
+only has to visit O(log n) nodes.
+
+For coarse lookups, CityGrid answers from a precomputed raster file,
+and the cell ids of City.cell map locations to integer ranges that the
+database can scan with an index.
+"""
+
+import heapq
+import math
+import mmap
+import struct
+from array import array
+
+# Mean earth radius [km], used for great-circle distances.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_xyz(lat, lng):
+    """Return the unit sphere (x, y, z) coordinates of lat/lng degrees."""
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lng), cos_lat * math.sin(lng), math.sin(lat))
+
+
+def chord_to_km(chord):
+    """Convert a chord length on the unit sphere into a great-circle
+    distance in km."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree(object):
+    """Static 3-d tree over (pk, lat, lng) points.
+
+    The tree is stored implicitly in one list: every slice of the list
+    is sorted along one axis and its middle element is the node that
+    splits the slice into the two subtrees.
+    """
+
+    def __init__(self, points):
+        self.nodes = [to_xyz(lat, lng) + (pk, lat, lng)
+                      for pk, lat, lng in points]
+        self._build(0, len(self.nodes), 0)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _build(self, lo, hi, axis):
+        if hi - lo < 2:
+            return
+        self.nodes[lo:hi] = sorted(self.nodes[lo:hi], key=lambda n: n[axis])
+        mid = (lo + hi) // 2
+        self._build(lo, mid, (axis + 1) % 3)
+        self._build(mid + 1, hi, (axis + 1) % 3)
+
+    def nearest(self, lat, lng, k=1):
+        """Return up to k (dist_km, pk, lat, lng) tuples for the points
+        closest to lat/lng, nearest first."""
+        if k < 1 or not self.nodes:
+            return []
+        point = to_xyz(lat, lng)
+        # Max-heap of (-squared chord, pk, lat, lng) for the best k hits.
+        heap = []
+        nodes = self.nodes
+
+        def search(lo, hi, axis):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            d2 = ((node[0] - point[0]) ** 2 + (node[1] - point[1]) ** 2 +
+                  (node[2] - point[2]) ** 2)
+            if len(heap) < k:
+                heapq.heappush(heap, (-d2, node[3], node[4], node[5]))
+            elif d2 < -heap[0][0]:
+                heapq.heapreplace(heap, (-d2, node[3], node[4], node[5]))
+            diff = point[axis] - node[axis]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            next_axis = (axis + 1) % 3
+            search(near[0], near[1], next_axis)
+            # Only cross the split plane if it is closer than the worst hit.
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                search(far[0], far[1], next_axis)
+
+        search(0, len(nodes), 0)
+        return [(chord_to_km(math.sqrt(-d2)), pk, plat, plng)
+                for d2, pk, plat, plng in sorted(heap, reverse=True)]
+
+
+# Bits per axis of a cell id. Cells are about 0.0055 degrees of latitude
+# high and 0.011 degrees of longitude wide, and ids fit into 30 bits.
+CELL_BITS = 15
+CELL_SIZE = 2 ** CELL_BITS
+
+
+def quantize(lat, lng):
+    """Return the (x, y) cell grid coordinates of lat/lng degrees."""
+    x = int((min(max(lng, -180.0), 180.0) + 180.0) / 360.0 * CELL_SIZE)
+    y = int((min(max(lat, -90.0), 90.0) + 90.0) / 180.0 * CELL_SIZE)
+    return min(x, CELL_SIZE - 1), min(y, CELL_SIZE - 1)
+
+
+def interleave(x, y):
+    """Return the Z-order (Morton) number of x and y: their bits
+    interleaved, so that nearby cells mostly get nearby numbers."""
+    z = 0
+    for i in range(CELL_BITS):
+        z |= ((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1)
+    return z
+
+
+def cell_id(lat, lng):
+    """Return the spatial cell id of lat/lng degrees."""
+    return interleave(*quantize(lat, lng))
+
+
+def cell_ranges(latmin, lngmin, latmax, lngmax, max_cells=16):
+    """Return a short list of (first, last) cell id ranges that together
+    cover the box.
+
+    The cells of a quadtree are split level by level, as long as the box
+    is covered by at most max_cells of them. Cells that are only partly
+    inside the box are kept whole, so the ranges may contain some cells
+    outside of it. Ranges of adjacent cells are merged.
+    """
+    x0, y0 = quantize(latmin, lngmin)
+    x1, y1 = quantize(latmax, lngmax)
+    # Cells as (level, x, y) on the 2**level x 2**level grid of a level.
+    full, partial = [], [(0, 0, 0)]
+    while partial:
+        new_full, children = [], []
+        for level, x, y in partial:
+            shift = CELL_BITS - level - 1
+            for cx, cy in ((2 * x, 2 * y), (2 * x + 1, 2 * y),
+                           (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)):
+                lox, hix = cx << shift, ((cx + 1) << shift) - 1
+                loy, hiy = cy << shift, ((cy + 1) << shift) - 1
+                if hix < x0 or lox > x1 or hiy < y0 or loy > y1:
+                    continue
+                if x0 <= lox and hix <= x1 and y0 <= loy and hiy <= y1:
+                    new_full.append((level + 1, cx, cy))
+                else:
+                    children.append((level + 1, cx, cy))
+        if len(full) + len(new_full) + len(children) > max_cells:
+            full += partial
+            break
+        full += new_full
+        partial = children
+
+    ranges = []
+    for level, x, y in full:
+        shift = 2 * (CELL_BITS - level)
+        first = interleave(x, y) << shift
+        ranges.append((first, first + (1 << shift) - 1))
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class CityGrid(object):
+    """Precomputed lat/lng grid with the nearest city of every cell.
+
+    The grid is stored in a binary file that is memory-mapped, so all
+    processes on a host share one copy through the page cache. The file
+    holds a header, the lats, lngs and pks of all cities, and for every
+    cell the index + 1 of the city nearest to the cell's center, or 0 if
+    there is none within max_km.
+    """
+
+    magic = b'DTRGRID1'
+    # magic, resolution [deg], rows, cols, number of cities, padding
+    header = struct.Struct('<8sdIIII')
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fh:
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.resolution, self.rows, self.cols, n, _ = \
+            self.header.unpack_from(self.mmap)
+        if magic != self.magic:
+            raise ValueError('Not a city grid file: ' + filename)
+        view = memoryview(self.mmap)
+        offset = self.header.size
+        self.lats = view[offset:offset + 8 * n].cast('d')
+        self.lngs = view[offset + 8 * n:offset + 16 * n].cast('d')
+        self.pks = view[offset + 16 * n:offset + 20 * n].cast('I')
+        self.cells = view[offset + 20 * n:].cast('I')
+
+    def cell(self, lat, lng):
+        """Return the (row, col) of the cell that contains lat/lng."""
+        row = int((min(max(lat, -90.0), 90.0) + 90.0) / self.resolution)
+        col = int((min(max(lng, -180.0), 180.0) + 180.0) / self.resolution)
+        return min(row, self.rows - 1), min(col, self.cols - 1)
+
+    def nearest(self, lat, lng):
+        """Return (dist_km, pk) of the city nearest to lat/lng, or None.
+
+        The candidates are the nearest cities of the cell of lat/lng and
+        its eight neighbours, the closest of them is returned. This is
+        exact for almost all locations, and otherwise off by at most
+        about one cell size.
+        """
+        row, col = self.cell(lat, lng)
+        candidates = set()
+        for r in (row - 1, row, row + 1):
+            if 0 <= r < self.rows:
+                for c in (col - 1, col, col + 1):
+                    value = self.cells[r * self.cols + c % self.cols]
+                    if value:
+                        candidates.add(value - 1)
+        if not candidates:
+            return None
+        point = to_xyz(lat, lng)
+
+        def chord2(i):
+            x, y, z = to_xyz(self.lats[i], self.lngs[i])
+            return (x - point[0]) ** 2 + (y - point[1]) ** 2 + \
+                (z - point[2]) ** 2
+        best = min(candidates, key=chord2)
+        return chord_to_km(math.sqrt(chord2(best))), self.pks[best]
+
+    @classmethod
+    def write(cls, filename, points, resolution, max_km, progress=None):
+        """Compute the grid for (pk, lat, lng) points and write it into
+        filename. progress, if given, is called with the number of rows
+        done after every row."""
+        points = list(points)
+        tree = KDTree(points)
+        position = {pk: i for i, (pk, lat, lng) in enumerate(points)}
+        rows = int(round(180.0 / resolution))
+        cols = int(round(360.0 / resolution))
+        cells = array('I', bytes(4 * rows * cols))
+        for row in range(rows):
+            lat = -90.0 + (row + 0.5) * resolution
+            for col in range(cols):
+                lng = -180.0 + (col + 0.5) * resolution
+                hits = tree.nearest(lat, lng)
+                if hits and hits[0][0] <= max_km:
+                    cells[row * cols + col] = position[hits[0][1]] + 1
+            if progress is not None:
+                progress(row + 1)
+        with open(filename, 'wb') as fh:
+            fh.write(cls.header.pack(cls.magic, resolution, rows, cols,
+                                     len(points), 0))
+            array('d', (e[1] for e in points)).tofile(fh)
+            array('d', (e[2] for e in points)).tofile(fh)
+            array('I', (e[0] for e in points)).tofile(fh)
+            cells.tofile(fh)
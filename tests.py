@@ -1,3 +1,722 @@
-from django.test import TestCase
+import bisect
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import zipfile
 
-# Create your tests here.
+from django.apps import apps
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from dtrcity import autocomplete
+from dtrcity.management.commands import import_cities
+from dtrcity.cache import MainAltNameCache, dataset_version, main_altnames
+from dtrcity.models import AltName, City, Country, Dataset, LocalizedPlace, \
+    Region, get_main_altnames, in_cells, make_search_key
+from dtrcity.serializers import iter_list
+from dtrcity.spatial import cell_ranges, interleave, quantize
+
+
+@override_settings(LANGUAGES=[('en', 'English'), ('de', 'German')],
+                   LANGUAGE_CODE='en')
+class ImportTestCase(TestCase):
+    """Runs single import_cities stages on a country with one region and
+    two cities."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        de = Country.objects.create(id=2921044, name='Germany', code='DE')
+        be = Region.objects.create(id=2950157, name='Berlin', code='DE.16',
+                                   country=de)
+        City.objects.create(id=2950159, name='Berlin', lat=52.52437,
+                            lng=13.41053, population=3426354,
+                            timezone='Europe/Berlin', country=de, region=be)
+        City.objects.create(id=2953386, name='Spandau', lat=52.53048,
+                            lng=13.19983, population=223962,
+                            timezone='Europe/Berlin', country=de, region=be)
+
+    def command(self, **options):
+        """Return an import_cities Command, set up like handle() does."""
+        cmd = import_cities.Command()
+        cmd.data_dir = self.data_dir
+        cmd.download_cache = {}
+        cmd.options = options
+        cmd.force = True
+        cmd.batch_size = 2
+        cmd.workers = options.get('workers', 1)
+        cmd.affected = None
+        cmd.queries = import_cities.QueryCounter()
+        cmd.download = lambda filekey: False
+        return cmd
+
+    def run_stages(self, cmd, *names):
+        # The stages print their progress.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name in names:
+                cmd.stage = import_cities.Stage(name, cmd.queries, 60)
+                getattr(cmd, name)()
+
+    def write_alt_names(self, lines):
+        fn = os.path.join(self.data_dir, 'alternateNames.zip')
+        with zipfile.ZipFile(fn, 'w') as zf:
+            zf.writestr('alternateNames.txt', '\n'.join(lines) + '\n')
+
+    def altnames(self):
+        return list(AltName.objects.order_by('pk').values_list(
+            'alternatename_id', 'geoname_id', 'language', 'name', 'slug',
+            'type', 'is_main', 'is_preferred', 'is_short', 'is_colloquial',
+            'is_historic'))
+
+
+# Daily diff files of 2016-03-01 in the geonames format.
+DIFF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', 'geonames')
+
+
+class IncrementalImportTest(ImportTestCase):
+    """Applies the diffs in DIFF_DIR to an imported data set."""
+
+    def setUp(self):
+        super(IncrementalImportTest, self).setUp()
+        for alternatename_id, geoname_id, type, language, name in (
+                (10, 2950159, 3, 'en', 'Berlin'),
+                (11, 2950159, 3, 'de', 'Berlin'),
+                (12, 2953386, 3, 'en', 'Spandau'),
+                (20, 2921044, 1, 'en', 'Germany'),
+                (21, 2921044, 1, 'de', 'Deutschland'),
+                (30, 2950157, 2, 'en', 'Land Berlin'),
+                (31, 2950157, 2, 'de', 'Berlin')):
+            AltName.objects.create(alternatename_id=alternatename_id,
+                                   geoname_id=geoname_id, type=type,
+                                   language=language, name=name)
+        self.run_stages(self.command(), 'fillup_alt_name',
+                        'define_main_alt_names',
+                        'make_crc_for_main_alt_names', 'build_read_model')
+
+    def place(self, geoname_id, language):
+        return LocalizedPlace.objects.filter(
+            type=3, geoname_id=geoname_id, language=language).first()
+
+    def run_incremental(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            call_command('import_cities', incremental=True,
+                         date='2016-03-01', diff_dir=DIFF_DIR,
+                         batch_size=2)
+        return out.getvalue()
+
+    def test_initial_import(self):
+        self.assertEqual(self.place(2950159, 'en').crc,
+                         'Berlin, Land Berlin, Germany')
+        self.assertEqual(self.place(2953386, 'de').crc,
+                         'Spandau, Berlin, Deutschland')
+
+    def test_deletes(self):
+        self.run_incremental()
+        self.assertFalse(City.objects.filter(pk=2953386).exists())
+        self.assertFalse(AltName.objects.filter(geoname_id=2953386).exists())
+        self.assertIsNone(self.place(2953386, 'en'))
+        self.assertIsNone(self.place(2953386, 'de'))
+
+    def test_modifications(self):
+        self.run_incremental()
+        berlin = City.objects.get(pk=2950159)
+        self.assertEqual(berlin.population, 3644826)
+        self.assertEqual(self.place(2950159, 'en').population, 3644826)
+        # A new city, but not a village or a region.
+        kopenick = City.objects.get(pk=6545310)
+        self.assertEqual(kopenick.region_id, 2950157)
+        self.assertNotEqual(kopenick.cell, 0)
+        self.assertFalse(City.objects.filter(pk=2833210).exists())
+        self.assertFalse(City.objects.filter(pk=2950157).exists())
+
+    def test_alt_name_deletes_and_main_election(self):
+        self.run_incremental()
+        self.assertFalse(AltName.objects.filter(alternatename_id=10)
+                         .exists())
+        # The deleted main name is replaced by the new short name.
+        mains = AltName.objects.filter(geoname_id=2950159, language='en',
+                                       is_main=True)
+        self.assertEqual([e.name for e in mains], ['Berlin City'])
+
+    def test_alt_name_modifications(self):
+        self.run_incremental()
+        self.assertEqual(AltName.objects.get(alternatename_id=31).name,
+                         'Berlin (Land)')
+        # The only English name of Germany became French, it is replaced
+        # by the country's name.
+        self.assertFalse(AltName.objects.filter(alternatename_id=20)
+                         .exists())
+        main = AltName.objects.get(geoname_id=2921044, language='en',
+                                   is_main=True)
+        self.assertEqual((main.name, main.alternatename_id),
+                         ('Germany', None))
+
+    def test_crc_and_url_recomputed(self):
+        self.run_incremental()
+        berlin_en = self.place(2950159, 'en')
+        self.assertEqual(berlin_en.crc, 'Berlin City, Land Berlin, Germany')
+        self.assertEqual(berlin_en.url, 'germany/land-berlin/berlin-city')
+        self.assertEqual(berlin_en.search, 'berlin city land berlin germany')
+        # The region's German name changed.
+        berlin_de = self.place(2950159, 'de')
+        self.assertEqual(berlin_de.crc, 'Berlin, Berlin (Land), Deutschland')
+        self.assertEqual(berlin_de.url, 'deutschland/berlin-land/berlin')
+        kopenick = self.place(6545310, 'de')
+        self.assertEqual(kopenick.crc,
+                         'Köpenick, Berlin (Land), Deutschland')
+        self.assertEqual(kopenick.url, 'deutschland/berlin-land/kopenick')
+        self.assertEqual(self.place(6545310, 'en').name, 'Köpenick')
+
+    def test_refresh_read_model(self):
+        self.run_incremental()
+        places = LocalizedPlace.objects.order_by(
+            'type', 'geoname_id', 'language')
+        rows = list(places.values_list('type', 'geoname_id', 'language',
+                                       'crc', 'url', 'population'))
+        # The refreshed read model is the same as a full rebuild.
+        self.run_stages(self.command(), 'build_read_model')
+        self.assertEqual(list(places.values_list(
+            'type', 'geoname_id', 'language', 'crc', 'url', 'population')),
+            rows)
+        self.assertEqual(len(rows), 2 * 4)
+
+    def test_only_changed_places_are_refreshed(self):
+        # A row of a place the diffs do not touch, which a full rebuild
+        # would drop.
+        LocalizedPlace.objects.create(type=3, geoname_id=2988507,
+                                      language='en', crc='Paris')
+        self.run_incremental()
+        self.assertEqual(self.place(2988507, 'en').crc, 'Paris')
+
+    def test_summary(self):
+        out = self.run_incremental()
+        stages = {e['stage']: e for e in json.loads(
+            out[out.index('{\n'):out.rindex('}') + 1])['stages']}
+        self.assertEqual(stages['apply_deletes']['skipped'],
+                         {'not a city': 1})
+        self.assertEqual(stages['apply_modifications']['skipped'],
+                         {'population': 1, 'not a city': 1})
+        self.assertEqual(stages['apply_alt_name_deletes']['skipped'],
+                         {'not found': 1})
+        self.assertEqual(stages['apply_alt_name_modifications']['skipped'],
+                         {'language': 1})
+
+
+class CitiesAroundTest(ImportTestCase):
+
+    def setUp(self):
+        super(CitiesAroundTest, self).setUp()
+        City.objects.create(id=2853658, name='Potsdam', lat=52.39886,
+                            lng=13.06566)
+        City.objects.create(id=2911298, name='Hamburg', lat=53.57532,
+                            lng=10.01534)
+        self.berlin = City.objects.get(pk=2950159)
+
+    def around(self, dist, **kwargs):
+        return City.get_cities_around_city(self.berlin, dist, exact=True,
+                                           **kwargs)
+
+    def test_nearest_first_with_distance(self):
+        cities = self.around(30)
+        self.assertEqual([e.pk for e in cities], [2950159, 2953386, 2853658])
+        self.assertAlmostEqual(cities[0].distance, 0)
+        self.assertAlmostEqual(cities[1].distance, 14.3, delta=0.1)
+        self.assertAlmostEqual(cities[2].distance, 27.2, delta=0.1)
+
+    def test_circle_not_square(self):
+        # Potsdam is inside the square around Berlin but not the circle.
+        self.assertIn(2853658, [e.pk for e in City.get_cities_around_city(
+            self.berlin, 25)])
+        self.assertEqual([e.pk for e in self.around(25)], [2950159, 2953386])
+
+    def test_limit(self):
+        self.assertEqual([e.pk for e in self.around(300, limit=2)],
+                         [2950159, 2953386])
+        self.assertEqual(len(self.around(300)), 4)
+
+
+class GetManyByTest(ImportTestCase):
+
+    def setUp(self):
+        super(GetManyByTest, self).setUp()
+        for geoname_id, crc, url in [
+                (2950159, 'Berlin, Berlin, Germany', 'germany/berlin/berlin'),
+                (2953386, 'Spandau, Berlin, Germany',
+                 'germany/berlin/spandau')]:
+            AltName.objects.create(geoname_id=geoname_id, type=3,
+                                   language='en', name=crc.split(',')[0],
+                                   crc=crc, url=url, is_main=True)
+        # Not main, and in another language.
+        AltName.objects.create(geoname_id=2953386, type=3, language='en',
+                               name='Berlin', crc='Berlin, Berlin, Germany',
+                               url='germany/berlin/berlin-2')
+        AltName.objects.create(geoname_id=2953386, type=3, language='de',
+                               name='Berlin', crc='Berlin, Berlin, Germany',
+                               url='germany/berlin/berlin', is_main=True)
+
+    def test_get_many_by_crc(self):
+        cities = City.get_many_by_crc(['Spandau, Berlin, Germany',
+                                       'Berlin, Berlin, Germany', 'Paris'])
+        self.assertEqual({k: v and v.pk for k, v in cities.items()}, {
+            'Spandau, Berlin, Germany': 2953386,
+            'Berlin, Berlin, Germany': 2950159, 'Paris': None})
+
+    def test_get_many_by_url(self):
+        with self.assertNumQueries(2):
+            cities = City.get_many_by_url(['germany/berlin/berlin',
+                                           'germany/berlin/berlin-2'])
+        self.assertEqual({k: v and v.pk for k, v in cities.items()}, {
+            'germany/berlin/berlin': 2950159,
+            'germany/berlin/berlin-2': None})
+
+
+class ReadModelTest(ImportTestCase):
+
+    def test_staging_models_are_not_registered(self):
+        models = apps.get_models()
+        self.run_stages(self.command(), 'build_read_model',
+                        'build_read_model')
+        self.assertEqual(apps.get_models(), models)
+
+
+class BulkUpdateTest(TestCase):
+
+    def test_more_objects_than_query_parameters(self):
+        AltName.objects.bulk_create(
+            AltName(geoname_id=i, type=3, language='en', name=str(i))
+            for i in range(600))
+        objs = list(AltName.objects.all())
+        for obj in objs:
+            obj.name = 'n{0}'.format(obj.geoname_id)
+            obj.slug = obj.name
+            obj.is_main = obj.geoname_id % 2 == 0
+        import_cities.bulk_update(AltName, objs, ['name', 'slug', 'is_main'])
+
+        rows = AltName.objects.values_list('geoname_id', 'name', 'slug',
+                                           'is_main')
+        self.assertEqual(sorted(rows), [
+            (i, 'n{0}'.format(i), 'n{0}'.format(i), i % 2 == 0)
+            for i in range(600)])
+
+
+class ImportAltNameTest(ImportTestCase):
+
+    def test_workers_write_the_same_rows_as_one_process(self):
+        ids = [2921044, 2950157, 2950159, 2953386, 1]
+        languages = ['en', 'de', 'fr']
+        lines = ['# comment']
+        for i in range(200):
+            lines.append('\t'.join([
+                str(100 + i), str(ids[i % len(ids)]), languages[i % 3],
+                '' if i % 17 == 0 else 'Näme {0}'.format(i),
+                '1' if i % 2 else '', '1' if i % 5 == 0 else '', '', '']))
+        self.write_alt_names(lines)
+        block_size = import_cities.conf['PARSE_BLOCK_SIZE']
+        import_cities.conf['PARSE_BLOCK_SIZE'] = 7
+        self.addCleanup(import_cities.conf.__setitem__, 'PARSE_BLOCK_SIZE',
+                        block_size)
+
+        cmd = self.command(workers=1)
+        self.run_stages(cmd, 'import_alt_name')
+        serial = self.altnames()
+        serial_skipped = cmd.stage.skipped
+        AltName.objects.all().delete()
+        cmd = self.command(workers=3)
+        self.run_stages(cmd, 'import_alt_name')
+
+        self.assertTrue(serial)
+        self.assertEqual(self.altnames(), serial)
+        self.assertEqual(cmd.stage.skipped, serial_skipped)
+        self.assertEqual(set(serial_skipped),
+                         {'empty name', 'language', 'geoname type'})
+
+    def test_rerun_updates_rows_and_replaces_legacy_names(self):
+        # A main name of a dump without alternateNameIds.
+        AltName.objects.create(geoname_id=2950159, type=3, language='en',
+                               name='Berlin', is_main=True)
+        self.write_alt_names([
+            '\t'.join(['10', '2950159', 'en', 'Berlin', '1', '', '', '']),
+            '\t'.join(['11', '2953386', 'en', 'Spandau', '', '', '', ''])])
+        cmd = self.command()
+        self.run_stages(cmd, 'import_alt_name', 'define_main_alt_names')
+        first = self.altnames()
+        self.write_alt_names([
+            '\t'.join(['10', '2950159', 'en', 'Berlin', '1', '', '', '']),
+            '\t'.join(['11', '2953386', 'en', 'Spandau-West', '', '', '',
+                       ''])])
+        self.run_stages(cmd, 'import_alt_name', 'define_main_alt_names')
+
+        self.assertEqual([e[0] for e in first], [10, 11])
+        self.assertTrue(all(e[6] for e in first))
+        rows = self.altnames()
+        self.assertEqual([e[0] for e in rows], [10, 11])
+        self.assertEqual(rows[1][3], 'Spandau-West')
+        self.assertTrue(all(e[6] for e in rows))
+
+
+class DefineMainAltNamesTest(ImportTestCase):
+    """The rules that elect the main name of a geo object, per language."""
+
+    def add(self, name, geoname_id=2950159, language='en', **flags):
+        return AltName.objects.create(geoname_id=geoname_id, type=3,
+                                      language=language, name=name, **flags)
+
+    def elect(self):
+        self.run_stages(self.command(), 'define_main_alt_names')
+        main_altnames.clear()
+        names = get_main_altnames(3, [2950159], 'en')
+        return names[2950159] and names[2950159].name
+
+    def test_sole_name(self):
+        self.add('Berlin', is_colloquial=True)
+        self.assertEqual(self.elect(), 'Berlin')
+
+    def test_short_before_preferred(self):
+        self.add('Berlin, Stadt')
+        self.add('City of Berlin', is_preferred=True)
+        self.add('Berlin', is_short=True)
+        self.assertEqual(self.elect(), 'Berlin')
+
+    def test_preferred_before_others(self):
+        self.add('Berlin, Stadt')
+        self.add('Berlin', is_preferred=True)
+        self.add('Bärlin', is_preferred=True)
+        self.assertEqual(self.elect(), 'Berlin')
+
+    def test_colloquial_names_come_last(self):
+        self.add('Spree-Athen', is_colloquial=True)
+        self.add('Berlin')
+        self.add('Berlin, Stadt')
+        self.assertEqual(self.elect(), 'Berlin')
+
+    def test_first_name_if_all_are_colloquial(self):
+        self.add('Spree-Athen', is_colloquial=True)
+        self.add('Bärlin', is_colloquial=True)
+        self.assertEqual(self.elect(), 'Spree-Athen')
+
+    def test_existing_main_is_kept(self):
+        self.add('Berlin', is_short=True)
+        self.add('Bärlin', is_main=True)
+        self.assertEqual(self.elect(), 'Bärlin')
+
+    def test_conflicting_mains_are_elected_again(self):
+        self.add('Bärlin', is_main=True)
+        self.add('Berlin', is_main=True, is_short=True)
+        self.assertEqual(self.elect(), 'Berlin')
+        self.assertEqual(AltName.objects.filter(is_main=True).count(), 1)
+
+    def test_one_main_per_language(self):
+        self.add('Berlin', is_short=True)
+        self.add('Berlin (de)', language='de')
+        self.add('Bärlin', language='de', is_preferred=True)
+        self.elect()
+        self.assertEqual(dict(AltName.objects.filter(is_main=True)
+                              .values_list('language', 'name')),
+                         {'en': 'Berlin', 'de': 'Bärlin'})
+        self.assertEqual(get_main_altnames(3, [2950159], 'de')[2950159].name,
+                         'Bärlin')
+
+    def test_no_name(self):
+        self.assertIsNone(self.elect())
+
+
+# Boxes (latmin, lngmin, latmax, lngmax) at the edges of the cell grid.
+EDGE_BOXES = [
+    (-10.0, 179.0, 10.0, 180.0),  # east of the antimeridian
+    (-10.0, -180.0, 10.0, -179.2),  # west of the antimeridian
+    (89.0, -180.0, 90.0, 180.0),  # north pole cap
+    (89.5, 170.0, 90.0, 180.0),  # north pole and antimeridian
+    (-90.0, -180.0, -89.3, -170.0),  # south pole and antimeridian
+    (-90.0, 10.0, -89.9, 10.5),
+    (52.5, 13.3, 52.6, 13.5),  # small box, many levels deep
+]
+
+
+class MainAltNameCacheTest(TestCase):
+    """Two caches stand for two processes with a shared cache."""
+
+    key = (3, 2950159, 'en')
+
+    def setUp(self):
+        caches['default'].clear()
+        dataset_version.clear()
+
+    def test_clear_and_delete_reach_other_processes(self):
+        a = MainAltNameCache(backend='default')
+        b = MainAltNameCache(backend='default')
+        a.set_many({self.key: 'Berlin'})
+        self.assertEqual(b.get_many([self.key]), {self.key: 'Berlin'})
+        a.clear()
+        self.assertEqual(b.get_many([self.key]), {})
+        a.set_many({self.key: 'Berlin, Stadt'})
+        self.assertEqual(b.get_many([self.key]), {self.key: 'Berlin, Stadt'})
+        a.delete(self.key)
+        self.assertEqual(b.get_many([self.key]), {})
+        self.assertEqual(a.get_many([self.key]), {})
+
+    def test_local_entries_of_an_older_version(self):
+        cache = MainAltNameCache()
+        cache.set_many({self.key: 'Berlin'})
+        self.assertEqual(cache.get_many([self.key]), {self.key: 'Berlin'})
+        Dataset.bump()
+        self.assertEqual(cache.get_many([self.key]), {})
+
+
+class CellRangesTest(SimpleTestCase):
+    """Compares cell_ranges() to a scan over all cells of a box."""
+
+    def assert_covers(self, box, max_cells=16):
+        ranges = cell_ranges(*box, max_cells=max_cells)
+        firsts = [e[0] for e in ranges]
+        for (a, b), (c, d) in zip(ranges, ranges[1:]):
+            self.assertLess(b + 1, c, 'ranges overlap or touch')
+        x0, y0 = quantize(box[0], box[1])
+        x1, y1 = quantize(box[2], box[3])
+        # Scan every 7th column and row, plus the edges of the box.
+        xs = sorted(set(range(x0, x1 + 1, 7)) | {x0, x1})
+        ys = sorted(set(range(y0, y1 + 1, 7)) | {y0, y1})
+        for x in xs:
+            for y in ys:
+                cell = interleave(x, y)
+                i = bisect.bisect_right(firsts, cell) - 1
+                self.assertTrue(i >= 0 and cell <= ranges[i][1],
+                                'cell {0} of {1} not covered'.format(
+                                    (x, y), box))
+
+    def test_edge_boxes(self):
+        for box in EDGE_BOXES:
+            self.assert_covers(box)
+            self.assert_covers(box, max_cells=4)
+
+    def test_random_boxes(self):
+        rnd = random.Random(14)
+        for i in range(50):
+            lat, lng = rnd.uniform(-90, 90), rnd.uniform(-180, 180)
+            box = (lat, lng, min(lat + rnd.uniform(0, 2), 90.0),
+                   min(lng + rnd.uniform(0, 2), 180.0))
+            self.assert_covers(box)
+
+
+class InCellsTest(TestCase):
+    """in_cells() selects the same cities as a scan of the box."""
+
+    def test_edge_boxes(self):
+        rnd = random.Random(14)
+        pk = 1
+        for latmin, lngmin, latmax, lngmax in EDGE_BOXES:
+            for i in range(30):
+                # Points in and around the box, and on its edges.
+                lat = rnd.choice([latmin, latmax, rnd.uniform(
+                    max(latmin - 1, -90), min(latmax + 1, 90))])
+                lng = rnd.choice([lngmin, lngmax, rnd.uniform(
+                    max(lngmin - 1, -180), min(lngmax + 1, 180))])
+                City.objects.create(id=pk, name=str(pk), lat=lat, lng=lng)
+                pk += 1
+        for latmin, lngmin, latmax, lngmax in EDGE_BOXES:
+            box = City.objects.filter(lat__gte=latmin, lng__gte=lngmin,
+                                      lat__lte=latmax, lng__lte=lngmax)
+            expected = set(box.values_list('pk', flat=True))
+            self.assertTrue(expected)
+            self.assertEqual(set(box.filter(in_cells(
+                latmin, lngmin, latmax, lngmax)).values_list('pk', flat=True)),
+                expected)
+
+
+@override_settings(LANGUAGES=[('en', 'English'), ('de', 'German')],
+                   LANGUAGE_CODE='en')
+class ApiTestCase(TestCase):
+    """Calls the API views with a few cities in the read model."""
+
+    # geoname_id, crc, lat, lng, population
+    CITIES = [
+        (3448439, 'São Paulo, SP, Brazil', -23.5475, -46.63611, 10021295),
+        (3455166, 'Paulo Afonso, BA, Brazil', -9.40611, -38.21472, 85350),
+        (5128581, 'New York, NY, United States', 40.71427, -74.00597,
+         8175133),
+        (5101798, 'Newark, NJ, United States', 40.73566, -74.17237, 281944),
+        (2950159, 'Berlin, Berlin, Germany', 52.52437, 13.41053, 3426354),
+    ]
+
+    def setUp(self):
+        dataset_version.clear()
+        autocomplete.reset_indexes()
+        for geoname_id, crc, lat, lng, population in self.CITIES:
+            LocalizedPlace.objects.create(
+                type=3, geoname_id=geoname_id, language='en', crc=crc,
+                search=make_search_key(crc), name=crc.split(',')[0],
+                lat=lat, lng=lng, population=population)
+
+    def get(self, path, **params):
+        return self.client.get('/api/v1/' + path, params)
+
+    def get_json(self, path, **params):
+        response = self.get(path, **params)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content) \
+            if response.streaming else response.content
+        return json.loads(content.decode('utf-8'))
+
+
+class AutocompleteTest(ApiTestCase):
+
+    def search(self, q, **params):
+        return self.get_json('autocomplete-crc.json', q=q, **params)
+
+    def test_prefix_matches_first(self):
+        self.assertEqual(self.search('paulo'), [
+            'Paulo Afonso, BA, Brazil', 'São Paulo, SP, Brazil'])
+
+    def test_alphabetical_order(self):
+        self.assertEqual(self.search('new'), [
+            'New York, NY, United States', 'Newark, NJ, United States'])
+
+    def test_accents_case_and_punctuation_ignored(self):
+        self.assertEqual(self.search('SAO-paulo'), ['São Paulo, SP, Brazil'])
+        self.assertEqual(self.search('berlin, berlin'),
+                         ['Berlin, Berlin, Germany'])
+
+    def test_trailing_separator_ends_a_word(self):
+        self.assertEqual(self.search('new '), ['New York, NY, United States'])
+        self.assertEqual(self.search('new,'), ['New York, NY, United States'])
+
+    def test_size_and_fields(self):
+        self.assertEqual(self.search('new', size=1),
+                         ['New York, NY, United States'])
+        self.assertEqual(
+            self.search('paulo', fields='geoname_id population'),
+            [{'geoname_id': 3455166, 'population': 85350},
+             {'geoname_id': 3448439, 'population': 10021295}])
+
+    def test_unknown_language(self):
+        self.assertEqual(self.get('autocomplete-crc.json', q='new',
+                                  lg='xx').status_code, 400)
+        self.assertEqual(self.search('new', lg='de'), [])
+
+
+class ConditionalResponseTest(ApiTestCase):
+
+    def setUp(self):
+        super(ConditionalResponseTest, self).setUp()
+        Dataset.objects.create(version=3, updated=datetime.datetime(
+            2016, 3, 1, 12, 0, tzinfo=datetime.timezone.utc))
+
+    def search(self, **headers):
+        return self.client.get('/api/v1/autocomplete-crc.json', {'q': 'new'},
+                               **headers)
+
+    def test_headers(self):
+        response = self.search()
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['ETag'], r'^"en-[0-9a-f]{32}"$')
+        self.assertEqual(response['Last-Modified'],
+                         'Tue, 01 Mar 2016 12:00:00 GMT')
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertEqual(response['Vary'], 'Accept-Language, Cookie')
+
+    def test_etag_depends_on_parameters_and_version(self):
+        etag = self.search()['ETag']
+        self.assertEqual(self.search()['ETag'], etag)
+        self.assertNotEqual(self.client.get('/api/v1/autocomplete-crc.json',
+                                            {'q': 'newa'})['ETag'], etag)
+        Dataset.bump()
+        self.assertNotEqual(self.search()['ETag'], etag)
+
+    def test_if_none_match(self):
+        etag = self.search()['ETag']
+        for header in [etag, 'W/' + etag, '"x", ' + etag, '*']:
+            response = self.search(HTTP_IF_NONE_MATCH=header)
+            self.assertEqual(response.status_code, 304, header)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response.content, b'')
+        for header in ['"x"', 'W/"x"']:
+            response = self.search(HTTP_IF_NONE_MATCH=header)
+            self.assertEqual(response.status_code, 200, header)
+
+    def test_if_modified_since(self):
+        self.assertEqual(self.search(
+            HTTP_IF_MODIFIED_SINCE='Tue, 01 Mar 2016 12:00:00 GMT'
+        ).status_code, 304)
+        self.assertEqual(self.search(
+            HTTP_IF_MODIFIED_SINCE='Tue, 01 Mar 2016 11:59:59 GMT'
+        ).status_code, 200)
+        # If-None-Match takes precedence.
+        self.assertEqual(self.search(
+            HTTP_IF_MODIFIED_SINCE='Tue, 01 Mar 2016 12:00:00 GMT',
+            HTTP_IF_NONE_MATCH='"x"').status_code, 200)
+
+    @override_settings(USE_TZ=False, TIME_ZONE='Europe/Berlin')
+    def test_last_modified_of_local_time(self):
+        Dataset.objects.update(updated=datetime.datetime(2016, 3, 1, 13, 0))
+        dataset_version.clear()
+        self.assertEqual(self.search()['Last-Modified'],
+                         'Tue, 01 Mar 2016 12:00:00 GMT')
+
+    def test_errors_have_no_etag(self):
+        response = self.client.get('/api/v1/autocomplete-crc.json',
+                                   {'q': 'n'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class CitiesByLatlngTest(ApiTestCase):
+
+    def post(self, body):
+        return self.client.post('/api/v1/cities-by-latlng.json', body,
+                                content_type='application/json')
+
+    def test_invalid_pairs(self):
+        for body in ['{}', '[[1, 2, 3]]', '[[true, 1]]', '[["1", 2]]',
+                     '[[1{0}, 2]]'.format('0' * 400), '[[91, 0]]', '[']:
+            self.assertEqual(self.post(body).status_code, 400, body)
+
+
+class CityItemsTest(ApiTestCase):
+
+    def setUp(self):
+        super(CityItemsTest, self).setUp()
+        LocalizedPlace.objects.filter(geoname_id=2950159).update(
+            url='germany/berlin/berlin')
+
+    def test_get_by_crc(self):
+        data = self.get_json('cities.json', crc=[
+            'Berlin, Berlin, Germany', 'Paris', ''])
+        self.assertEqual(set(data), {'Berlin, Berlin, Germany', 'Paris'})
+        self.assertIsNone(data['Paris'])
+        berlin = data['Berlin, Berlin, Germany']
+        self.assertEqual(berlin['id'], 2950159)
+        self.assertEqual((berlin['city_name'], berlin['region_name'],
+                          berlin['country_name']),
+                         ('Berlin', 'Berlin', 'Germany'))
+
+    def test_post_by_url(self):
+        response = self.client.post('/api/v1/cities.json', json.dumps(
+            {'url': ['germany/berlin/berlin', 'x/y/z']}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['germany/berlin/berlin']['crc'],
+                         'Berlin, Berlin, Germany')
+        self.assertIsNone(data['x/y/z'])
+
+    def test_invalid_post(self):
+        for body in ['[]', '{"url": "germany/berlin/berlin"}', '{']:
+            response = self.client.post('/api/v1/cities.json', body,
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+
+
+class IterListTest(SimpleTestCase):
+
+    def test_chunks_make_one_list(self):
+        for n in [0, 1, 499, 500, 501, 1234]:
+            items = [[i, 'Näme {0}'.format(i)] for i in range(n)]
+            content = b''.join(iter_list(iter(items)))
+            self.assertEqual(json.loads(content.decode('utf-8')), items)
@@ -15,6 +15,15 @@ urlpatterns = [
     url(r'^api/v1/city-by-latlng.json$',
         city_views.city_by_latlng, name='city_by_latlng'),
 
+    url(r'^api/v1/cities-by-latlng.json$',
+        city_views.cities_by_latlng, name='cities_by_latlng'),
+
+    url(r'^api/v1/stats.txt$',
+        city_views.api_stats, name='api_stats'),
+
+    url(r'^api/v1/cities.json$',
+        city_views.city_items, name='city_items'),
+
     url(r'^api/v1/(?P<country>[a-z0-9-]+)/(?P<region>[a-z0-9-]+)/'
         r'(?P<city>[a-z0-9-]+).json$',
         city_views.city_item, name='city_item'),
@@ -1,41 +1,103 @@
+import itertools
 import json
+import math
+import sys
+from array import array
 
 from django.conf import settings
+from django.db.models import Q
 from django.http import HttpResponse, Http404
 from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
 from django.utils.translation import get_language
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from dtrcity.models import AltName, City, Country
+from dtrcity import autocomplete, instrumentation
+from dtrcity.decorators import cached_response, conditional_response
+from dtrcity.models import City, LocalizedPlace
+from dtrcity.serializers import json_response, streaming_json_response
+
+# Rows read per query by cities_in_country.
+CITIES_PAGE_SIZE = 2000
 
 
 @require_http_methods(["GET", "HEAD"])
+@conditional_response()
 def city_item(request, country, region, city):
     url = '/'.join([country, region, city])
     lg = get_language()[:2]
-    an = get_object_or_404(AltName, url=url, language=lg, type=3, is_main=True)
-    city = get_object_or_404(City, pk=an.geoname_id)
-    city_name, region_name, country_name = an.crc.split(', ', 2)
-    x = {'id': city.id, 'lat': city.lat, 'lng': city.lng,
-         'timezone': city.timezone, 'population': city.population,
-         'language': an.language, 'city_name': city_name,
-         'region_name': region_name, 'country_name': country_name,
-         'url': an.url, 'crc': an.crc, 'name': an.name, 'slug': an.slug}
-    return HttpResponse(json.dumps(x), content_type="application/json")
+    an = get_object_or_404(LocalizedPlace, url=url, language=lg, type=3)
+    return json_response(item_data(an))
+
+
+@csrf_exempt
+@require_http_methods(["GET", "HEAD", "POST"])
+def city_items(request):
+    """
+    Return the city_item data of many cities, by url or crc.
+
+    GET "url" or "crc", repeated once per city, e.g.
+        ?url=de/berlin/berlin&url=fr/ile-de-france/paris
+    or POST a JSON object with a list of "url" or "crc" strings:
+        {"url": ["de/berlin/berlin", "fr/ile-de-france/paris"]}
+
+    Returns a JSON object with the data of each city keyed by the given
+    string, or null for strings that match no city. Empty strings are
+    ignored. All cities are looked up with one query.
+    """
+    max_keys = getattr(settings, 'CITY_ITEMS_MAX_KEYS', 1000)
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+            field = 'url' if 'url' in data else 'crc'
+            names = data.get(field, [])
+        except (AttributeError, TypeError, ValueError):
+            return HttpResponseBadRequest('Expected a JSON object.')
+        if not isinstance(names, list):
+            return HttpResponseBadRequest('Expected a list of strings.')
+        names = [str(e) for e in names]
+    else:
+        field = 'url' if 'url' in request.GET else 'crc'
+        names = request.GET.getlist(field)
+    # An empty string would match all rows without a url or crc.
+    names = [e for e in names if e]
+    if len(names) > max_keys:
+        return HttpResponseBadRequest('Max. {} cities.'.format(max_keys))
+
+    lg = get_language()[:2]
+    rows = LocalizedPlace.objects.filter(language=lg, type=3,
+                                         **{field + '__in': set(names)})
+    found = {}
+    for an in rows.order_by('pk'):
+        found.setdefault(getattr(an, field), an)
+    return json_response({name: item_data(found[name]) if name in found
+                          else None for name in names})
+
+
+def item_data(an):
+    """Return the data of a LocalizedPlace city for the city item views."""
+    # Missing parts of a short crc, e.g. of a city without region, are ''.
+    parts = an.crc.split(', ', 2)
+    city_name, region_name, country_name = parts + [''] * (3 - len(parts))
+    return {'id': an.geoname_id, 'lat': an.lat, 'lng': an.lng,
+            'timezone': an.timezone, 'population': an.population,
+            'language': an.language, 'city_name': city_name,
+            'region_name': region_name, 'country_name': country_name,
+            'url': an.url, 'crc': an.crc, 'name': an.name, 'slug': an.slug}
 
 
 @require_http_methods(["GET", "HEAD"])
+@cached_response()
 def all_countries(request):
     lang = get_language()[:2]
-    countries = Country.objects.all()
-    an = AltName.objects.filter(geoname_id__in=countries, is_main=True,
-                                type=1, language=lang).order_by('name')
-    li = [(x.geoname_id, x.name) for x in an]
-    return HttpResponse(json.dumps(li), content_type="application/json")
+    an = LocalizedPlace.objects.filter(type=1, language=lang).order_by('name')
+    li = list(an.values_list('geoname_id', 'name'))
+    return json_response(li)
 
 
 @require_http_methods(["GET"])
+@cached_response('q', 'population', 'size')
 def cities_in_country(request):
     """Returns a list of (geoname_id, crc) pairs."""
     # The client may request only cities larger than GET "population".
@@ -44,21 +106,56 @@ def cities_in_country(request):
     language = get_language()[:2]
     # Max item count to be returned.
     size = int(request.GET.get('size', 10000))
-    # Find the Country object GET "q"
+    # The Country pk from GET "q".
     try:
-        country = get_object_or_404(Country, pk=request.GET.get('q', None))
-    except ValueError:  # not an int
+        country = int(request.GET.get('q', None))
+    except (TypeError, ValueError):  # not an int
         raise Http404('No Country matches the given query.')
-    # Find all City objects in the country of the required size.
-    cities = City.objects.filter(country=country, population__gt=population)
-    # Finally, look up the localized names of the City objects.
-    data = AltName.objects.filter(geoname_id__in=cities, is_main=True, type=3,
-                                  language=get_language()[:2]).order_by('crc')
-    li = [(x.geoname_id, x.crc) for x in data[:size]]
-    return HttpResponse(json.dumps(li), content_type="application/json")
+    # Look up the localized names of the cities in the country of the
+    # required size.
+    data = LocalizedPlace.objects.filter(type=3, language=language,
+                                         country_id=country,
+                                         population__gt=population)
+    # Stream the rows page by page, look at the first one to tell an
+    # empty result from an unknown country.
+    rows = iter_by_crc(data, size)
+    first = next(rows, None)
+    if first is None:
+        if not LocalizedPlace.objects.filter(type=1,
+                                             geoname_id=country).exists():
+            raise Http404('No Country matches the given query.')
+        return json_response([])
+    return streaming_json_response(itertools.chain([first], rows))
+
+
+def iter_by_crc(queryset, size):
+    """Yield up to size (geoname_id, crc) rows of the queryset, ordered by
+    crc and pk.
+
+    The rows are read with one query per CITIES_PAGE_SIZE rows, each
+    continuing after the (crc, pk) of the last row, because
+    QuerySet.iterator() of this Django version does not use a server
+    side cursor, and the database client would fetch all rows at once.
+    """
+    last = None
+    while size > 0:
+        page = queryset
+        if last is not None:
+            page = page.filter(Q(crc__gt=last[0]) |
+                               Q(crc=last[0], pk__gt=last[1]))
+        limit = min(size, CITIES_PAGE_SIZE)
+        rows = list(page.order_by('crc', 'pk').values_list(
+            'crc', 'pk', 'geoname_id')[:limit])
+        for crc, pk, geoname_id in rows:
+            yield geoname_id, crc
+        if len(rows) < limit:
+            return
+        size -= len(rows)
+        last = rows[-1][:2]
 
 
 @require_http_methods(["GET", "HEAD"])
+@conditional_response('latitude', 'longitude')
 def city_by_latlng(request):
     """
     Receive GET lat/lng and return localized info on nearest city.
@@ -70,33 +167,99 @@ def city_by_latlng(request):
     try:
         lat = float(request.GET.get('latitude', None))
         lng = float(request.GET.get('longitude', None))
-    except TypeError:
+    except (TypeError, ValueError):
         return HttpResponseBadRequest()
-    try:
-        city = City.by_latlng(lat, lng)
-    except City.DoesNotExist:
+    if not valid_latlng(lat, lng):
+        return HttpResponseBadRequest()
+    pk = City.nearest_pk(lat, lng)
+    if pk is None:
         raise Http404
     try:
-        an = AltName.objects.get(geoname_id=city.pk, type=3,
-                                 is_main=True, language=settings.LANGUAGE_CODE)
-    except AltName.DoesNotExist:
+        an = LocalizedPlace.objects.get(geoname_id=pk, type=3,
+                                        language=settings.LANGUAGE_CODE)
+    except LocalizedPlace.DoesNotExist:
         raise Http404
+    return json_response(latlng_data(an))
 
-    return HttpResponse(json.dumps({
-        "id": city.id,
-        "lat": city.lat,
-        "lng": city.lng,
-        "region": city.region.pk,
-        "country": city.country.pk,
-        "population": city.population,
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def cities_by_latlng(request):
+    """
+    Receive many lat/lng pairs and return localized info on the nearest
+    city of each.
+
+    The POST body is either JSON, a list of [latitude, longitude] pairs,
+    or with content type "application/octet-stream" a packed array of
+    little-endian float64 values: lat, lng, lat, lng, ...
+
+    Returns a list in the order of the input pairs, with the same data
+    as city_by_latlng for each pair, or null if there is no city near
+    the location. Every latitude must be in [-90, 90] and every
+    longitude in [-180, 180].
+    """
+    # The nearest city search takes about 40 us per distinct pair.
+    max_points = getattr(settings, 'CITY_BY_LATLNG_MAX_POINTS', 1000)
+    try:
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith('application/octet-stream'):
+            values = array('d', request.body)
+            if sys.byteorder != 'little':
+                values.byteswap()
+            if len(values) % 2:
+                raise ValueError('Odd number of values.')
+            points = list(zip(values[0::2], values[1::2]))
+        else:
+            data = json.loads(request.body.decode('utf-8'))
+            if not isinstance(data, list) or not all(
+                    isinstance(e, list) and len(e) == 2 and
+                    all(isinstance(x, (int, float)) and
+                        not isinstance(x, bool) for x in e) for e in data):
+                raise ValueError('Not a list of pairs.')
+            points = [(float(lat), float(lng)) for lat, lng in data]
+    except (TypeError, ValueError, OverflowError):
+        # OverflowError: float() of a JSON integer with 309 or more digits.
+        return HttpResponseBadRequest('Expected a list of lat/lng pairs.')
+    if len(points) > max_points:
+        return HttpResponseBadRequest('Max. {} pairs.'.format(max_points))
+    if not all(valid_latlng(lat, lng) for lat, lng in points):
+        return HttpResponseBadRequest('Invalid lat/lng values.')
+
+    # Look up repeated pairs only once.
+    distinct = list(set(points))
+    nearest = dict(zip(distinct, City.nearest_pks(distinct)))
+    pks = [nearest[e] for e in points]
+    found = set(pk for pk in pks if pk is not None)
+    altnames = {x.geoname_id: x for x in LocalizedPlace.objects.filter(
+        geoname_id__in=found, type=3, language=settings.LANGUAGE_CODE)}
+    li = [latlng_data(altnames[pk]) if pk in altnames else None for pk in pks]
+    return json_response(li)
+
+
+def valid_latlng(lat, lng):
+    """Return True if lat and lng are finite and within their range."""
+    return (math.isfinite(lat) and math.isfinite(lng) and
+            -90 <= lat <= 90 and -180 <= lng <= 180)
+
+
+def latlng_data(an):
+    """Return the data of a LocalizedPlace city for the lat/lng views."""
+    return {
+        "id": an.geoname_id,
+        "lat": an.lat,
+        "lng": an.lng,
+        "region": an.region_id,
+        "country": an.country_id,
+        "population": an.population,
         "slug": an.slug,
         "name": an.name,
         "crc": an.crc,
         "url": an.url,
-    }), content_type="application/json")
+    }
 
 
 @require_http_methods(["GET", "HEAD"])
+@conditional_response('q', 'lg', 'size', 'fields', 'flat')
 def city_autocomplete_crc(request):
     """Returns a json list of matching AltName.crc objects.
 
@@ -118,7 +281,8 @@ def city_autocomplete_crc(request):
 
     Result is ordered alphabetically with those values first that begin
     with q, followed by values that contain q somewhere else in the
-    string.
+    string. Matching ignores case, accents and punctuation, so "sao
+    paulo" finds "São Paulo, ...".
 
     Only crc values of type=3 (city) and in the selected language are
     returned.
@@ -136,32 +300,49 @@ def city_autocomplete_crc(request):
         flat = False
     if not q or len(q) < min_len:
         return HttpResponseBadRequest('Min. length {} chars.'.format(min_len))
+    # Each language has an index in memory, so only languages of the site
+    # are accepted.
+    if lg not in [e[0] for e in settings.LANGUAGES]:
+        return HttpResponseBadRequest('Unknown language.')
 
-    # First lookup all crc values in AltName that begin with q.
-    an = AltName.objects.filter(crc__istartswith=q, language=lg, type=3)
-    if flat:
-        an = an.values_list(*fields, flat=True)
+    # Find the positions of all crc values that begin with q, followed
+    # by those that contain q, in the in-memory index.
+    index = autocomplete.get_index(lg)
+    hits = index.search(q, size)
+    if fields == ['crc']:
+        li = [index.crcs[pos] for pos in hits]
+        if not flat:
+            li = [{'crc': x} for x in li]
     else:
-        an = an.values(*fields)
-    li = [x for x in an.order_by('crc')[:size]]
-
-    # If there are less than "size" values, lookup names that just
-    # contain q.
-    if len(li) < size:
-        rsize = size - len(li)
-        an = AltName.objects.filter(crc__icontains=q, language=lg, type=3)\
-                            .exclude(crc__istartswith=q)
+        # Fetch the requested fields of all hits with one lookup.
+        ids = [index.geoname_ids[pos] for pos in hits]
+        rows = {x['geoname_id']: x for x in
+                LocalizedPlace.objects.filter(type=3, language=lg,
+                                              geoname_id__in=ids)
+                .values('geoname_id', *fields)}
+        li = [rows[pk] for pk in ids if pk in rows]
         if flat:
-            an = an.values_list(*fields, flat=True)
-        else:
-            an = an.values(*fields)
-        li += [x for x in an.order_by('crc')[:rsize]]
+            li = [x[fields[0]] for x in li]
+        elif 'geoname_id' not in fields:
+            for x in li:
+                del x['geoname_id']
     # Finally, clean up.
     if flat:
         li = list_uniq(li)
     # else:
     #    li = list_uniq(li)
-    return HttpResponse(json.dumps(li), content_type="application/json")
+    return json_response(li)
+
+
+@require_http_methods(["GET", "HEAD"])
+def api_stats(request):
+    """Return the request stats of this process in the Prometheus text
+    format, see dtrcity.instrumentation. Only if the DTRCITY_STATS_VIEW
+    setting is True."""
+    if not getattr(settings, 'DTRCITY_STATS_VIEW', False):
+        raise Http404
+    return HttpResponse(instrumentation.stats.prometheus(),
+                        content_type='text/plain; version=0.0.4')
 
 
 def list_uniq(seq):